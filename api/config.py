@@ -6,6 +6,7 @@ Uses .env to store settings that change between environments, and for secrets.
 # System Imports
 from datetime import timedelta
 from functools import lru_cache
+from typing import Optional
 from json import loads
 import os
 from enum import Enum
@@ -21,6 +22,17 @@ from pydantic import BaseSettings
 # to be duplicated here. sorry.
 
 
+class IdStrategy(str, Enum):
+    """How primary keys of new rows are generated"""
+
+    # md5 based random uuid built by postgres (server_default)
+    SERVER = "server"
+    # random uuid built in python
+    UUID4 = "uuid4"
+    # time ordered uuid built in python, keeps the primary key index append-only
+    UUID7 = "uuid7"
+
+
 @lru_cache()
 def get_settings():
     return Settings()
@@ -48,6 +60,8 @@ class Settings(BaseSettings):
     # Jinja2 template filenames
     NOTE_TEMPLATE = "note_template.html"
     JINJA_FILE_PATH = "api/meta/jinja_templates/"
+    # Compiled JINJA_FILE_PATH templates, None for a directory in the temp dir
+    JINJA_BYTECODE_CACHE_PATH: Optional[str] = None
 
     # Connection to Postgres database
     DATABASE_HOST: str = ""
@@ -56,6 +70,89 @@ class Settings(BaseSettings):
     DATABASE_NAME: str = ""
     POSTGRES_PLUGINS = ["fuzzystrmatch"]
 
+    # Read replicas, GET requests are spread over them in round-robin
+    DATABASE_REPLICA_HOSTS: list[str] = []
+    # Seconds a failing replica is skipped before being tried again
+    DATABASE_REPLICA_RETRY: int = 30
+    # Seconds a client keeps reading from the primary after a write
+    DATABASE_REPLICA_STICKY: int = 5
+
+    # Connection pool, one per worker process
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 2
+    DATABASE_POOL_TIMEOUT: int = 30  # seconds
+    DATABASE_POOL_RECYCLE: int = 1800  # 30 minutes
+    DATABASE_CONNECT_TIMEOUT: int = 15  # seconds
+    # Log a warning when a request waits longer than this for a connection
+    DATABASE_POOL_WAIT_WARNING: float = 1.0  # seconds
+    # Compiled statements kept per engine, keyed by statement shape
+    DATABASE_STATEMENT_CACHE_SIZE: int = 500
+    # Serve the routers with async handlers and an asyncpg AsyncSession
+    DATABASE_ASYNC: bool = False
+    ID_STRATEGY: IdStrategy = IdStrategy.UUID7
+    # Relationships that a query didn't load explicitly raise instead of lazy loading
+    RAISE_ON_LAZY_LOAD: bool = False
+
+    # Pagination of the list endpoints
+    PAGE_SIZE: int = 50
+    MAX_PAGE_SIZE: int = 200
+    # Most notes that DELETE /notes/bulk takes in one request
+    MAX_BULK_DELETE: int = 1000
+
+    # POST /notes/batch
+    MAX_BATCH_NOTES: int = 1000
+    # Batches bigger than this are written with COPY instead of INSERT
+    BATCH_COPY_THRESHOLD: int = 200
+    # Reject the whole batch if any note is invalid, else create the valid ones
+    BATCH_ALL_OR_NOTHING: bool = True
+
+    # Notes fetched from the server-side cursor per chunk of GET /notes/export
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # bcrypt cost, each round doubles the time of a hash, calibrate it with
+    # python -m api.utils.hashing --target-ms 250
+    BCRYPT_ROUNDS: int = 12
+    # gunicorn workers, gunicorn reads it too, the process pools of the
+    # workers share the cores out between them
+    WEB_CONCURRENCY: int = 1
+    # bcrypt worker processes of each worker, defaults to the cores divided by
+    # WEB_CONCURRENCY, 0 hashes in threads
+    HASHING_PROCESSES: Optional[int] = None
+    # Password hashes waiting for a process before signups and logins get a 429
+    HASHING_QUEUE_SIZE: int = 64
+    # Compiled note description templates each worker keeps
+    TEMPLATE_CACHE_SIZE: int = 1024
+    # Note template rendering processes of each worker, defaults like
+    # HASHING_PROCESSES, 0 renders in threads
+    RENDER_PROCESSES: Optional[int] = None
+    # Renders waiting for a process before new ones are refused with a 429,
+    # never more than can finish within RENDER_TIMEOUT at RENDER_CPU_SECONDS each
+    RENDER_QUEUE_SIZE: int = 64
+    # CPU time a single render may use, only enforced in render processes
+    RENDER_CPU_SECONDS: float = 1.0
+    # Longest a view waits for its render, queueing included
+    RENDER_TIMEOUT: float = 5.0  # seconds
+    # Longest rendered description, in characters
+    RENDER_MAX_OUTPUT: int = 1_000_000
+    # Store the rendered description with the note instead of rendering every view
+    RENDER_ON_WRITE: bool = False
+    # Verified JWT payloads each worker keeps, until the token expires
+    VERIFIED_TOKEN_CACHE_SIZE: int = 10000
+    # Authenticated users each worker keeps, changes reach other workers within the ttl
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL: int = 30  # seconds
+    # Usernames each worker remembers as taken, to refuse signups before bcrypt
+    TAKEN_USERNAMES_CACHE_SIZE: int = 10000
+    TAKEN_USERNAMES_CACHE_TTL: int = 300  # seconds
+    # Note list pages each worker keeps, writes through other workers show
+    # up once the ttl expires
+    NOTE_PAGE_CACHE: bool = True
+    # Bytes of page bodies each worker keeps, a full page of MAX_PAGE_SIZE
+    # notes with 128 character titles is about 40 KB, 32 MB holds 800 of them
+    NOTE_PAGE_CACHE_BYTES: int = 32 * 1024 * 1024
+    # Users whose note pages each worker keeps track of
+    NOTE_PAGE_CACHE_USERS: int = 10000
+    NOTE_PAGE_CACHE_TTL: int = 5  # seconds
     SECRET = ""
     FLAG = "MONSEC{sup3r_s3cr3t_fl4g}"
 
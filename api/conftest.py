@@ -13,6 +13,9 @@ from typing import Generator
 from sqlalchemy.orm import Session, sessionmaker
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+from fastapi import FastAPI
 from sqlalchemy_utils import (
     database_exists,
     create_database,
@@ -21,7 +24,10 @@ from sqlalchemy_utils import (
 
 # Local Imports
 from api.main import app
-from api.utils.database import get_db
+from api.endpoints import notes, user
+from api.utils import responses
+from api.utils.cache import clear_caches
+from api.utils.database import get_db, get_async_db, RAISE_ON_LAZY_LOAD
 from api.config import get_settings
 from api.meta.database.model import Base
 
@@ -117,6 +123,9 @@ def client(test_db) -> Generator:
         # Force all endpoints to use our test db session.
         app.dependency_overrides[get_db] = override_db
 
+        # Every relationship the endpoints use must be loaded explicitly
+        test_db.info[RAISE_ON_LAZY_LOAD] = True
+
         # Force all endpoints to use our firebase auth override
         # app.dependency_overrides[require_firebase_auth] = override_firebase
 
@@ -130,4 +139,72 @@ def client(test_db) -> Generator:
             yield tClient
 
         # Rollback any changes made to the database from endpoints
+        test_db.info.pop(RAISE_ON_LAZY_LOAD)
         test_db.rollback()
+        # and forget what the caches learnt from them
+        clear_caches()
+
+
+# The app with the routers DATABASE_ASYNC serves, whatever the setting is
+async_app = FastAPI(default_response_class=responses.JSONResponse)
+for exception, handler in app.exception_handlers.items():
+    async_app.add_exception_handler(exception, handler)
+async_app.router.redirect_slashes = False
+async_app.include_router(user.async_router, prefix="/user")
+async_app.include_router(notes.async_router, prefix="/notes")
+
+
+# Test client of the async routers
+@pytest.fixture(scope="function")
+def async_client(test_session) -> Generator:
+    # asyncpg connections belong to the event loop of the client, don't pool them
+    engine = create_async_engine(
+        test_session.kw["bind"].url.set(drivername="postgresql+asyncpg"),
+        poolclass=NullPool,
+    )
+    sessions = []
+
+    async def override_db():
+        # opened in the event loop of the client by the first request
+        if not sessions:
+            connection = await engine.connect()
+            await connection.begin()
+            await connection.begin_nested()
+            session = AsyncSession(
+                bind=connection, autoflush=False, expire_on_commit=False
+            )
+            session.sync_session.info[RAISE_ON_LAZY_LOAD] = True
+
+            # endpoints commit the SAVEPOINT, reopen it each time
+            @event.listens_for(session.sync_session, "after_transaction_end")
+            def restart_savepoint(session, transaction):
+                if not connection.sync_connection.in_nested_transaction():
+                    connection.sync_connection.begin_nested()
+
+            sessions.append(session)
+        return sessions[0]
+
+    async def rollback():
+        # Rollback any changes made to the database from endpoints
+        for session in sessions:
+            connection = session.bind
+            await session.close()
+            await connection.rollback()
+            await connection.close()
+        await engine.dispose()
+
+    async_app.dependency_overrides[get_async_db] = override_db
+    with TestClient(async_app) as tClient:
+        yield tClient
+        tClient.portal.call(rollback)
+
+    async_app.dependency_overrides.clear()
+    clear_caches()
+
+
+# Runs the test against the sync routers, then the async ones
+@pytest.fixture(scope="function", params=["sync", "async"])
+def any_client(request) -> Generator:
+    yield request.getfixturevalue(
+        "client" if request.param == "sync" else "async_client"
+    )
@@ -5,49 +5,428 @@ Endpoints for creating, viewing, deleting notes.
 
 
 # Package imports
+import json
+from datetime import datetime
+from itertools import count
+from threading import Lock
+from typing import NamedTuple, Optional
 from uuid import UUID
 
-from jinja2 import Environment, BaseLoader
-from fastapi import APIRouter, HTTPException, status, Query, Depends
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import delete, update
 
 # Local imports
 from api.config import get_settings
-from api.utils.auth import AuthHandler, require_user_account
-from api.utils.database import get_db
+from api.utils import metrics
+from api.utils.auth import (
+    AuthHandler,
+    Principal,
+    require_user_account,
+    require_user_account_async,
+)
+from api.utils.database import (
+    get_db,
+    get_async_db,
+    reads_from_replica,
+    release_connections,
+    release_connections_async,
+)
+from api.utils.pagination import decode_cursor, encode_cursor, page_size
+from api.utils.cache import LRUCache
+from api.utils.bulk import copy_rows, copy_rows_async, insert_rows, insert_rows_async
+from api.utils.responses import (
+    JSONResponse,
+    etag_matches,
+    make_etag,
+    not_modified,
+)
+from api.utils.rows import (
+    NoteExportRow,
+    NoteListRow,
+    fetch_rows,
+    fetch_rows_async,
+    select_rows,
+)
+from api.utils.statements import (
+    note_version,
+    note_with_owner,
+    notes_page,
+    notes_version,
+)
+from api.utils.templates import (
+    RENDERER_VERSION,
+    get_note_page,
+    note_renderer,
+    prerender,
+    prerender_async,
+    stored_rendering,
+)
 from api.meta.constants.schemas import (
     NotePayload,
+    NoteBatchPayload,
+    NoteBatchRejection,
+    NoteBatchResult,
     NoteDeletePayload,
+    NoteBulkDeletePayload,
+    NoteBulkDeleteResult,
     NoteObject,
-    SimplifiedNoteObject,
+    NotePage,
 )
-from api.meta.database.model import User, Note
+from api.meta.database.model import Note, newId, time_now
 from api.meta.constants.errors import (
     SOMETHING_WENT_WRONG,
     NOTE_DOES_NOT_EXIST,
     USER_NOT_AUTHORIZED,
+    INVALID_NOTE_BATCH,
 )
 
 # ---------------
 # Setup Router
 # ---------------
+# The hot endpoints return their content already shaped like their
+# response_model in a JSONResponse, FastAPI then sends it as is instead of
+# validating and encoding every row again. response_model only documents
+# them, keep the two in sync.
 router = APIRouter()
+async_router = APIRouter()
 settings = get_settings()
 auth_handler = AuthHandler()
 
 get_db = Depends(get_db)
+get_async_db = Depends(get_async_db)
 require_user_account = Depends(require_user_account)
+require_user_account_async = Depends(require_user_account_async)
+
+# Note list pages this worker read from the primary, by (owner, generation,
+# limit, cursor). Every write to the notes of a user gives them a new
+# generation, so a page read before the write is never served after it, even
+# if cached later.
+# Writes through other workers aren't seen, their pages expire with the ttl.
+# Pages are bounded by the bytes of their bodies, their count says little.
+note_pages = LRUCache(
+    settings.NOTE_PAGE_CACHE_BYTES,
+    ttl=settings.NOTE_PAGE_CACHE_TTL,
+    weigh=lambda page: len(page.body),
+)
+note_page_generations = LRUCache(settings.NOTE_PAGE_CACHE_USERS)
+metrics.register("note_pages", note_pages.stats)
+
+# a user whose generation was evicted gets a new one, never an old one back
+_generations = count()
+_generations_lock = Lock()
+
+
+class CachedPage(NamedTuple):
+    etag: str
+    body: bytes
+
+
+def note_page_key(user_id: UUID, limit: int, cursor: Optional[str]):
+    """Key of the page in note_pages, None when the cache is off"""
+    if not settings.NOTE_PAGE_CACHE:
+        return None
+    with _generations_lock:
+        generation = note_page_generations.get(user_id)
+        if generation is None:
+            generation = next(_generations)
+            note_page_generations.set(user_id, generation)
+    return (user_id, generation, limit, cursor)
+
+
+def forget_note_pages(user_id: UUID) -> None:
+    """Stop serving the cached pages of the user, after a write to their notes"""
+    with _generations_lock:
+        note_page_generations.set(user_id, next(_generations))
+
+
+def cached_page_response(page: CachedPage, if_none_match: Optional[str]) -> Response:
+    if etag_matches(if_none_match, page.etag):
+        return not_modified(page.etag)
+    return Response(
+        page.body, media_type="application/json", headers={"ETag": page.etag}
+    )
+
+
+def build_notes_page(notes: list, limit: int) -> dict:
+    """
+    The NotePage of the rows, trimming the extra row fetched by notes_page
+    into the next cursor
+    """
+    next_cursor = None
+    if len(notes) > limit:
+        notes = notes[:limit]
+        next_cursor = encode_cursor(notes[-1].created_date, notes[-1].id)
+
+    return {
+        "notes": [{"id": note.id, "title": note.title} for note in notes],
+        "next_cursor": next_cursor,
+    }
+
+
+def delete_notes_query(user_id: UUID, ids: list):
+    """Delete the given notes of the user, returning the ids that existed"""
+    note = Note.__table__
+    return (
+        delete(note)
+        .where(note.c.user_id == user_id, note.c.id.in_(ids))
+        .returning(note.c.id)
+    )
+
+
+def store_rendering_query(note_id: UUID, description: str, rendered: str):
+    """
+    Store the rendering of a note, unless its description changed since it
+    was read, that rendering would be stale
+    """
+    note = Note.__table__
+    return (
+        update(note)
+        .where(note.c.id == note_id, note.c.description == description)
+        .values(
+            rendered_description=rendered,
+            rendered_version=RENDERER_VERSION,
+            # a rendering isn't a change of the note, keep its ETag
+            updated_date=note.c.updated_date,
+        )
+    )
+
+
+def owner_is_admin(note: Optional[Note]) -> Optional[bool]:
+    return None if note is None else note.user.is_admin
+
+
+def check_note_access(owner_is_admin: Optional[bool], user: Principal) -> None:
+    """
+    Refuse a missing note, whose owner_is_admin is None, and an admin note
+    to a non admin
+    """
+    if owner_is_admin is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=NOTE_DOES_NOT_EXIST,
+        )
+
+    # if the note belongs to an admin and the current user is not
+    if (owner_is_admin is True) and (not user.is_admin):
+        # raise an error
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=USER_NOT_AUTHORIZED,
+        )
+
+
+def note_etag(note_id: UUID, updated_date: datetime) -> str:
+    """ETag of a note view, a new renderer may render it differently"""
+    return make_etag("note", note_id, updated_date.timestamp(), RENDERER_VERSION)
+
+
+def notes_page_etag(
+    user_id: UUID, limit: int, cursor: Optional[str], version: tuple
+) -> str:
+    """ETag of a page of the user notes, from the notes_version of the user"""
+    latest, count = version
+    return make_etag(
+        "notes", user_id, limit, cursor, latest and latest.timestamp(), count
+    )
+
+
+def store_rendering(db: Session, note_id: UUID, description: str, rendered: str):
+    """Store the rendering of a note, failing only costs a render next time"""
+    try:
+        db.execute(store_rendering_query(note_id, description, rendered))
+        db.commit()
+    except Exception:
+        db.rollback()
+
+
+async def describe_note(db: Session, note: Note) -> dict:
+    """
+    The NoteObject of the note, with its rendered description. Awaits the
+    render in the event loop, only the queries take a thread.
+    """
+    # the rendering stored with the note, if RENDER_ON_WRITE made one
+    response = {
+        "id": note.id,
+        "title": note.title,
+        "description": stored_rendering(note),
+    }
+    if response["description"] is not None:
+        return response
+
+    # a render can take up to RENDER_TIMEOUT, the pooled connections are
+    # given back first, the commit below expires the note
+    description = note.description
+    await run_in_threadpool(release_connections, db)
+
+    # Jinja template rendering, from string, in a render process
+    # VULN: renders the template when using {{}}
+    response["description"] = await note_renderer.render_async(description)
+
+    # notes older than render-on-write, or than RENDERER_VERSION, are stored
+    # on their first view
+    if settings.RENDER_ON_WRITE:
+        await run_in_threadpool(
+            store_rendering, db, response["id"], description, response["description"]
+        )
+
+    return response
+
+
+async def describe_note_async(db: AsyncSession, note: Note) -> dict:
+    """Async version of describe_note"""
+    response = {
+        "id": note.id,
+        "title": note.title,
+        "description": stored_rendering(note),
+    }
+    if response["description"] is not None:
+        return response
+
+    description = note.description
+    await release_connections_async(db)
+
+    # VULN: renders the template when using {{}}
+    response["description"] = await note_renderer.render_async(description)
+
+    if settings.RENDER_ON_WRITE:
+        try:
+            await db.execute(
+                store_rendering_query(
+                    response["id"], description, response["description"]
+                )
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+
+    return response
+
+
+def note_page_response(note: dict) -> StreamingResponse:
+    """The HTML page of the note, sent chunk by chunk as the template renders"""
+    page = get_note_page().generate(note=note)
+    return StreamingResponse(page, media_type="text/html")
+
+
+def build_bulk_delete_result(ids: list, deleted: list) -> NoteBulkDeleteResult:
+    """Split the requested ids into deleted and not found"""
+    deleted = set(deleted)
+    return NoteBulkDeleteResult(
+        deleted=[id for id in ids if id in deleted],
+        not_found=[id for id in ids if id not in deleted],
+    )
+
+
+def validate_note_batch(notes: list) -> tuple:
+    """
+    Check every note against the column sizes, returns the valid notes
+    and a rejection for each invalid one
+    """
+    limits = {
+        "title": Note.__table__.c.title.type.length,
+        "description": Note.__table__.c.description.type.length,
+    }
+
+    valid, rejected = [], []
+    for index, note in enumerate(notes):
+        errors = [
+            f"{field} is longer than {length} characters"
+            for field, length in limits.items()
+            if len(getattr(note, field)) > length
+        ]
+        if errors:
+            rejected.append(NoteBatchRejection(index=index, msg=", ".join(errors)))
+        else:
+            valid.append(note)
+
+    if rejected and settings.BATCH_ALL_OR_NOTHING:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{INVALID_NOTE_BATCH}: "
+            + "; ".join(f"note {reject.index} {reject.msg}" for reject in rejected),
+        )
+
+    return valid, rejected
+
+
+def build_note_rows(user_id: UUID, notes: list, renderings: list) -> list:
+    """
+    Column values of the new notes, ids included unless the server makes
+    them, and the prerender columns of each note
+    """
+    now = time_now()
+    rows = []
+    for note, rendering in zip(notes, renderings):
+        row = {
+            "created_date": now,
+            "updated_date": now,
+            "title": note.title,
+            "description": note.description,
+            "user_id": user_id,
+            **rendering,
+        }
+        if newId is not None:
+            row["id"] = newId()
+        rows.append(row)
+    return rows
+
+
+def use_copy(rows: list) -> bool:
+    """COPY pays off for big batches, but it can't return server made ids"""
+    return newId is not None and len(rows) > settings.BATCH_COPY_THRESHOLD
+
+
+def export_notes_query(user_id: UUID):
+    """Every note of the user, oldest first, read through a server-side cursor"""
+    note = Note.__table__
+    return (
+        select_rows(NoteExportRow, note)
+        .where(note.c.user_id == user_id)
+        .order_by(note.c.created_date, note.c.id)
+        .execution_options(stream_results=True)
+    )
+
+
+def note_to_ndjson(row: NoteExportRow) -> str:
+    """One line of the NDJSON export"""
+    return (
+        json.dumps(
+            {
+                "id": str(row.id),
+                "title": row.title,
+                "description": row.description,
+                "created_date": row.created_date.isoformat(),
+                "updated_date": row.updated_date.isoformat(),
+            }
+        )
+        + "\n"
+    )
 
 
 @router.get(
     "",
     status_code=status.HTTP_200_OK,
-    response_model=NoteObject | list,
+    response_model=NotePage,
 )
 def fetch_notes(
     user_id: UUID = Query(None, alias="user-id"),
-    user: User = require_user_account,
+    limit: int = Query(None, ge=1),
+    cursor: str = Query(None),
+    if_none_match: str = Header(None),
+    user: Principal = require_user_account,
     db: Session = get_db,
 ):
     """
@@ -58,21 +437,41 @@ def fetch_notes(
 
     Args:
         - user_id:UUID the user_id passed will retrieve the user notes
+        - limit:int the page size, capped at MAX_PAGE_SIZE
+        - cursor:str the next_cursor of the previous page
+        - If-None-Match header: the ETag of a previous response
     Returns:
-        - List with secrets of the user
+        - Page with secrets of the user, and the cursor of the next page,
+          or 304 if the ETag still matches
     """
     # If there is no user id input, then use the one from the db
     # NOTE: Vuln here, we should not trust user data
     if user_id is None:
         user_id = user.id
 
-    notes = (
-        db.query(Note)
-        .filter(Note.user_id == user_id)
-        .order_by(Note.created_date.desc())
-        .all()
-    )
-    return [SimplifiedNoteObject(id=note.id, title=note.title) for note in notes]
+    limit = page_size(limit)
+    after = decode_cursor(cursor) if cursor is not None else None
+
+    # taken before reading, a write meanwhile retires the key
+    key = note_page_key(user_id, limit, cursor)
+    page = note_pages.get(key) if key is not None else None
+    if page is not None:
+        return cached_page_response(page, if_none_match)
+
+    # the version is read first, a note added before the page is read only
+    # makes the next poll download the page again
+    version = db.execute(notes_version(user_id)).one()
+    etag = notes_page_etag(user_id, limit, cursor, version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    notes = fetch_rows(db, notes_page(user_id, after, limit), NoteListRow)
+    page = CachedPage(etag, JSONResponse(build_notes_page(notes, limit)).body)
+    # a lagging replica can miss a write made since the key was taken, the
+    # page would then be served in place of the new one until the ttl
+    if key is not None and not reads_from_replica(db):
+        note_pages.set(key, page)
+    return cached_page_response(page, None)
 
 
 @router.post(
@@ -81,7 +480,7 @@ def fetch_notes(
 )
 def create_note(
     note: NotePayload,
-    user: User = require_user_account,
+    user: Principal = require_user_account,
     db: Session = get_db,
 ):
     """
@@ -98,12 +497,14 @@ def create_note(
         user_id=user.id,
         title=note.title,
         description=note.description,
+        **prerender(note.description),
     )
 
     # try to add to the database
     try:
         db.add(new_note)
         db.commit()
+        forget_note_pages(user.id)
 
     # catch any error
     except Exception:
@@ -113,6 +514,48 @@ def create_note(
         )
 
 
+@router.post(
+    "/batch",
+    status_code=status.HTTP_201_CREATED,
+    response_model=NoteBatchResult,
+)
+def create_notes(
+    batch: NoteBatchPayload,
+    user: Principal = require_user_account,
+    db: Session = get_db,
+):
+    """
+    This creates several notes in the given user, in one transaction
+    Args:
+        - notes: list of {title, description}
+    Returns:
+        - The ids of the created notes, in order, and the rejected notes
+    """
+    notes, rejected = validate_note_batch(batch.notes)
+    renderings = [prerender(note.description) for note in notes]
+    rows = build_note_rows(user.id, notes, renderings)
+
+    try:
+        if not rows:
+            ids = []
+        elif use_copy(rows):
+            copy_rows(db, Note.__table__, rows)
+            ids = [row["id"] for row in rows]
+        else:
+            ids = insert_rows(db, Note.__table__, rows)
+        db.commit()
+        forget_note_pages(user.id)
+
+    except Exception:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
+        )
+
+    return NoteBatchResult(ids=ids, rejected=rejected)
+
+
 @router.delete(
     "",
     status_code=status.HTTP_200_OK,
@@ -120,31 +563,51 @@ def create_note(
 def delete_note(
     note: NoteDeletePayload,
     db: Session = get_db,
-    user: User = require_user_account,
+    user: Principal = require_user_account,
 ):
 
-    # retrieve note from db
-    note = (
-        db.query(Note)
-        .filter(
-            and_(
-                Note.user_id == user.id,
-                Note.id == note.id,
-            ),
+    # delete the note in a single round trip
+    try:
+        result = db.execute(delete_notes_query(user.id, [note.id]))
+        db.commit()
+        forget_note_pages(user.id)
+    except Exception:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
         )
-        .one_or_none()
-    )
 
-    if note is None:
+    # nothing deleted: the note doesn't exist or belongs to someone else
+    if result.rowcount == 0:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=NOTE_DOES_NOT_EXIST,
         )
 
-    # delete note
+
+@router.delete(
+    "/bulk",
+    status_code=status.HTTP_200_OK,
+    response_model=NoteBulkDeleteResult,
+)
+def delete_notes(
+    notes: NoteBulkDeletePayload,
+    db: Session = get_db,
+    user: Principal = require_user_account,
+):
+    """
+    This deletes several notes of the user in a single statement
+    Args:
+        - ids: list of the note UUIDs to delete
+    Returns:
+        - The deleted ids, and the ones that were not found
+    """
+
     try:
-        db.delete(note)
+        deleted = db.execute(delete_notes_query(user.id, notes.ids)).scalars().all()
         db.commit()
+        forget_note_pages(user.id)
     except Exception:
         db.rollback()
         raise HTTPException(
@@ -152,14 +615,63 @@ def delete_note(
             detail=SOMETHING_WENT_WRONG,
         )
 
+    return build_bulk_delete_result(notes.ids, deleted)
+
 
+@router.get(
+    "/export",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+def export_notes(
+    request: Request,
+    user: Principal = require_user_account,
+    db: Session = get_db,
+):
+    """
+    This streams every note of the user as NDJSON, one note per line.
+    Notes are read in batches from a server-side cursor so memory stays
+    flat whatever the number of notes.
+    Returns:
+        - application/x-ndjson stream of {id, title, description,
+          created_date, updated_date}
+    """
+    result = db.execute(export_notes_query(user.id)).yield_per(
+        settings.EXPORT_BATCH_SIZE
+    )
+
+    partitions = result.partitions()
+
+    async def stream():
+        # batches are fetched in the threadpool, the stream stops as soon as
+        # the client goes away and closes the cursor and the session itself
+        # rather than leaving them to the garbage collector
+        try:
+            while not await request.is_disconnected():
+                partition = await run_in_threadpool(next, partitions, None)
+                if partition is None:
+                    break
+                yield "".join(
+                    note_to_ndjson(NoteExportRow._make(row)) for row in partition
+                )
+        finally:
+            result.close()
+            db.close()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# The views wait for their render in the event loop, a thread is only taken
+# for their queries, so slow renders can't leave the other sync routes
+# without threads
 @router.get(
     "/{note_id}",
     status_code=status.HTTP_200_OK,
     response_model=NoteObject,
 )
-def view_note(
+async def view_note(
     note_id: UUID = Query(None, alias="note-id"),
+    if_none_match: str = Header(None),
     user=require_user_account,
     db: Session = get_db,
 ):
@@ -169,39 +681,296 @@ def view_note(
     NOTE: This is meant to be vulnerable, this won't
     check for correct user, only for a valid session.
 
+    Args:
+        - note_id: UUID, the UUID of the note to display
+        - If-None-Match header: the ETag of a previous response
+
+    Returns:
+        - Jinja2 template rendered (Vulnerability), or 304 if the ETag
+          still matches
+    """
+
+    # a client with a copy only needs the version of the note to reuse it
+    if if_none_match is not None:
+        result = await run_in_threadpool(db.execute, note_version(note_id))
+        version = result.one_or_none()
+        check_note_access(version and version.is_admin, user)
+        etag = note_etag(note_id, version.updated_date)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    # get note from db, with its owner in the same round trip
+    result = await run_in_threadpool(db.execute, note_with_owner(note_id))
+    note = result.scalars().one_or_none()
+
+    check_note_access(owner_is_admin(note), user)
+    etag = note_etag(note.id, note.updated_date)
+    return JSONResponse(await describe_note(db, note), headers={"ETag": etag})
+
+
+@router.get(
+    "/{note_id}/html",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def view_note_html(
+    note_id: UUID = Query(None, alias="note-id"),
+    user=require_user_account,
+    db: Session = get_db,
+):
+    """
+    This endpoint returns the note given the UUID as an HTML page
+
+    NOTE: This is meant to be vulnerable, this won't
+    check for correct user, only for a valid session.
+
     Args:
         - note_id: UUID, the UUID of the note to display
 
     Returns:
-        - Jinja2 template rendered (Vulnerability)
+        - text/html page of the note, streamed as it renders
     """
+    result = await run_in_threadpool(db.execute, note_with_owner(note_id))
+    note = result.scalars().one_or_none()
+    check_note_access(owner_is_admin(note), user)
+    return note_page_response(await describe_note(db, note))
+
+
+# ---------------
+# Async handlers
+# ---------------
+# Same endpoints as above, served instead of them when DATABASE_ASYNC is set.
+
+
+@async_router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_model=NotePage,
+)
+async def fetch_notes_async(
+    user_id: UUID = Query(None, alias="user-id"),
+    limit: int = Query(None, ge=1),
+    cursor: str = Query(None),
+    if_none_match: str = Header(None),
+    user: Principal = require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of fetch_notes"""
+    # NOTE: Vuln here, we should not trust user data
+    if user_id is None:
+        user_id = user.id
+
+    limit = page_size(limit)
+    after = decode_cursor(cursor) if cursor is not None else None
+
+    key = note_page_key(user_id, limit, cursor)
+    page = note_pages.get(key) if key is not None else None
+    if page is not None:
+        return cached_page_response(page, if_none_match)
+
+    version = (await db.execute(notes_version(user_id))).one()
+    etag = notes_page_etag(user_id, limit, cursor, version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    notes = await fetch_rows_async(db, notes_page(user_id, after, limit), NoteListRow)
+    page = CachedPage(etag, JSONResponse(build_notes_page(notes, limit)).body)
+    if key is not None and not reads_from_replica(db.sync_session):
+        note_pages.set(key, page)
+    return cached_page_response(page, None)
+
+
+@async_router.post(
+    "",
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_note_async(
+    note: NotePayload,
+    user: Principal = require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of create_note"""
+
+    new_note = Note(
+        user_id=user.id,
+        title=note.title,
+        description=note.description,
+        **await prerender_async(note.description),
+    )
+
+    try:
+        db.add(new_note)
+        await db.commit()
+        forget_note_pages(user.id)
 
-    # get note from db
-    note = db.query(Note).filter(Note.id == note_id).one_or_none()
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
+        )
+
+
+@async_router.post(
+    "/batch",
+    status_code=status.HTTP_201_CREATED,
+    response_model=NoteBatchResult,
+)
+async def create_notes_async(
+    batch: NoteBatchPayload,
+    user: Principal = require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of create_notes"""
+    notes, rejected = validate_note_batch(batch.notes)
+    renderings = [await prerender_async(note.description) for note in notes]
+    rows = build_note_rows(user.id, notes, renderings)
 
-    if note is None:
+    try:
+        if not rows:
+            ids = []
+        elif use_copy(rows):
+            await copy_rows_async(db, Note.__table__, rows)
+            ids = [row["id"] for row in rows]
+        else:
+            ids = await insert_rows_async(db, Note.__table__, rows)
+        await db.commit()
+        forget_note_pages(user.id)
+
+    except Exception:
+        await db.rollback()
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
+        )
+
+    return NoteBatchResult(ids=ids, rejected=rejected)
+
+
+@async_router.delete(
+    "",
+    status_code=status.HTTP_200_OK,
+)
+async def delete_note_async(
+    note: NoteDeletePayload,
+    db: AsyncSession = get_async_db,
+    user: Principal = require_user_account_async,
+):
+    """Async version of delete_note"""
+
+    try:
+        result = await db.execute(delete_notes_query(user.id, [note.id]))
+        await db.commit()
+        forget_note_pages(user.id)
+    except Exception:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
+        )
+
+    if result.rowcount == 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
             detail=NOTE_DOES_NOT_EXIST,
         )
 
-    # if the note belongs to an admin and the current user is not
-    if (note.user.is_admin is True) and (not user.is_admin):
-        # raise an error
+
+@async_router.delete(
+    "/bulk",
+    status_code=status.HTTP_200_OK,
+    response_model=NoteBulkDeleteResult,
+)
+async def delete_notes_async(
+    notes: NoteBulkDeletePayload,
+    db: AsyncSession = get_async_db,
+    user: Principal = require_user_account_async,
+):
+    """Async version of delete_notes"""
+
+    try:
+        result = await db.execute(delete_notes_query(user.id, notes.ids))
+        deleted = result.scalars().all()
+        await db.commit()
+        forget_note_pages(user.id)
+    except Exception:
+        await db.rollback()
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=USER_NOT_AUTHORIZED,
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
         )
 
-    # Jinja template rendering, from string
-    # VULN: renders the template when using {{}}
-    template_env = Environment(loader=BaseLoader)
-    description = template_env.from_string(note.description)
-    description_text = description.render()
+    return build_bulk_delete_result(notes.ids, deleted)
 
-    # return the template
-    return NoteObject(
-        id=note.id,
-        title=note.title,
-        description=description_text,
-    )
+
+@async_router.get(
+    "/export",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def export_notes_async(
+    request: Request,
+    user: Principal = require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of export_notes"""
+    result = await db.stream(export_notes_query(user.id))
+    result = result.yield_per(settings.EXPORT_BATCH_SIZE)
+
+    async def stream():
+        try:
+            async for partition in result.partitions():
+                if await request.is_disconnected():
+                    break
+                yield "".join(
+                    note_to_ndjson(NoteExportRow._make(row)) for row in partition
+                )
+        finally:
+            await result.close()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@async_router.get(
+    "/{note_id}",
+    status_code=status.HTTP_200_OK,
+    response_model=NoteObject,
+)
+async def view_note_async(
+    note_id: UUID = Query(None, alias="note-id"),
+    if_none_match: str = Header(None),
+    user=require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of view_note"""
+
+    if if_none_match is not None:
+        version = (await db.execute(note_version(note_id))).one_or_none()
+        check_note_access(version and version.is_admin, user)
+        etag = note_etag(note_id, version.updated_date)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    # the owner is needed for the admin check, and can't be lazy loaded here
+    result = await db.execute(note_with_owner(note_id))
+    note = result.scalars().one_or_none()
+
+    check_note_access(owner_is_admin(note), user)
+    etag = note_etag(note.id, note.updated_date)
+    return JSONResponse(await describe_note_async(db, note), headers={"ETag": etag})
+
+
+@async_router.get(
+    "/{note_id}/html",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def view_note_html_async(
+    note_id: UUID = Query(None, alias="note-id"),
+    user=require_user_account_async,
+    db: AsyncSession = get_async_db,
+):
+    """Async version of view_note_html"""
+    result = await db.execute(note_with_owner(note_id))
+    note = result.scalars().one_or_none()
+    check_note_access(owner_is_admin(note), user)
+    return note_page_response(await describe_note_async(db, note))
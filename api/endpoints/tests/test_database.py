@@ -2,6 +2,7 @@
 test_database.py
 Tests for the user endpoints
 """
+from time import sleep
 from uuid import uuid4, UUID
 
 # Package Imports
@@ -9,14 +10,18 @@ import pytest
 from fastapi.testclient import TestClient
 from fastapi import status
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func, insert, select, text
+from sqlalchemy.exc import IntegrityError
 from pprint import pprint as pp
 
 # Local Imports
 from api.utils.auth import AuthHandler
 import api.meta.database.factories as fac
 import api.meta.database.model as mdl
-from api.config import get_settings
+from api.config import IdStrategy, get_settings
+from api.utils import database, metrics
+from api.meta.database.migrate import missing_indexes
+from api.meta.database.ids import uuid7
 
 # -------------------------
 settings = get_settings()
@@ -260,3 +265,202 @@ def test_delete_user_and_notes_cascade(test_db: Session):
     # check that the note has been deleted
     note = test_db.query(mdl.Note).filter(mdl.Note.id == note_id).one_or_none()
     assert note is None
+
+
+def test_engine_is_shared_between_sessions():
+    """
+    This test ensures that every session is handed out by the same
+    long-lived engine instead of building a new pool per request.
+    """
+    engine = database.get_engine()
+    assert database.get_engine() is engine
+    assert database.get_sessionmaker()().get_bind() is engine
+
+    stats = database.pool_stats()
+    assert stats[database.PRIMARY]["size"] == settings.DATABASE_POOL_SIZE
+
+    # disposing empties the registry, the next call builds a fresh engine
+    database.dispose_engines()
+    assert database.pool_stats() == {}
+    assert database.get_engine() is not engine
+
+
+def test_pool_telemetry(monkeypatch, caplog):
+    """
+    This test ensures that checkouts, connection recycles and slow
+    checkouts of the registered engines are reported.
+    """
+    monkeypatch.setattr(settings, "DATABASE_POOL_WAIT_WARNING", 0)
+    database.dispose_engines()
+    engine = database.get_engine()
+
+    with caplog.at_level("WARNING", logger="api.utils.pool"):
+        with engine.connect() as connection:
+            connection.connection.invalidate()
+        with engine.connect():
+            pass
+
+    stats = metrics.snapshot()["pools"][database.PRIMARY]
+    assert stats["wait_seconds"]["count"] == 2
+    assert stats["age_seconds"]["count"] == 2
+    assert stats["connects"] == 2
+    assert stats["recycles"] == 1
+    assert stats["invalidations"] == 1
+    assert stats["slow_checkouts"] == 2
+    assert stats["peak_checked_out"] == 1
+    assert stats["overflow_in_use"] == 0
+    # warnings are rate limited
+    assert len(caplog.records) == 1
+    assert "primary pool saturated" in caplog.text
+
+    # the telemetry outlives the pool swap of engine.dispose()
+    engine.dispose()
+    with engine.connect():
+        pass
+    assert metrics.snapshot()["pools"][database.PRIMARY]["connects"] == 3
+    database.dispose_engines()
+
+
+def test_model_indexes_exist(test_db: Session):
+    """
+    This test ensures that every index declared on the models
+    is present in the database.
+    """
+    assert missing_indexes(test_db.get_bind()) == []
+
+
+def test_usernames_are_unique_ignoring_case(test_db: Session):
+    """
+    This test ensures that the database rejects two users whose
+    usernames only differ by case.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.User_factory.create(username="monsec")
+    test_db.flush()
+
+    with pytest.raises(IntegrityError):
+        with test_db.begin_nested():
+            fac.User_factory.create(username="MONSEC")
+
+    count = (
+        test_db.query(mdl.User)
+        .filter(func.lower(mdl.User.username) == "monsec")
+        .count()
+    )
+    assert count == 1
+
+
+def test_uuid7_ids_are_time_ordered():
+    """
+    This test ensures that uuid7 ids are valid version 7 uuids
+    that sort in creation order.
+    """
+    first = uuid7()
+    sleep(0.002)
+    second = uuid7()
+
+    assert first.version == 7 and second.version == 7
+    assert first < second
+
+
+@pytest.mark.skipif(
+    settings.ID_STRATEGY != IdStrategy.UUID7,
+    reason="only for the uuid7 id strategy",
+)
+def test_new_rows_get_uuid7_ids(test_db: Session):
+    """
+    This test ensures that rows inserted through the ORM
+    get a uuid7 id generated in python.
+    """
+    user = mdl.User(username="test", password="random")
+    test_db.add(user)
+    test_db.flush()
+
+    assert user.id.version == 7
+
+
+def test_replicas_are_chosen_round_robin_while_healthy(monkeypatch):
+    """
+    This test ensures that reads rotate over the replicas, skipping
+    the ones marked down, and fall back to the primary when none is left.
+    """
+    monkeypatch.setattr(settings, "DATABASE_REPLICA_HOSTS", ["replica-a", "replica-b"])
+    monkeypatch.setattr(database, "_replica_down_until", {})
+
+    chosen = {database.choose_replica() for _ in range(4)}
+    assert chosen == {"replica-0", "replica-1"}
+
+    database.mark_replica_down("replica-0")
+    assert {database.choose_replica() for _ in range(4)} == {"replica-1"}
+
+    database.mark_replica_down("replica-1")
+    assert database.choose_replica() is None
+
+
+def test_replica_connections_survive_a_replica_restart(monkeypatch):
+    """
+    This test ensures that a pooled replica connection the server closed,
+    as after a replica restart, is replaced at checkout instead of failing
+    the next read.
+    """
+    monkeypatch.setattr(settings, "DATABASE_REPLICA_HOSTS", [settings.DATABASE_HOST])
+    monkeypatch.setattr(database, "_replica_down_until", {})
+
+    try:
+        replica = database.connect_to_replica()
+        pid = replica.execute(text("SELECT pg_backend_pid()")).scalar()
+        replica.close()
+
+        with database.get_engine().connect() as primary:
+            primary.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": pid})
+
+        replica = database.connect_to_replica()
+        assert replica.execute(text("SELECT 1")).scalar() == 1
+        replica.close()
+    finally:
+        database.dispose_engines()
+
+
+def test_routing_session_reads_its_own_writes(test_db: Session):
+    """
+    This test ensures that a routing session connects to its replica on
+    its first read, reads from it until it writes, then sticks to the primary.
+    """
+    primary = test_db.get_bind()
+    connections = []
+
+    def connect():
+        connections.append(primary.connect())
+        return connections[-1]
+
+    replica = database.ReplicaLink(connect)
+    db = database.RoutingSession(bind=primary, info={database.REPLICA: replica})
+
+    try:
+        assert connections == []
+        assert db.get_bind(clause=select(mdl.User.id)) is connections[0]
+        assert db.get_bind(clause=select(mdl.User.id)) is connections[0]
+        assert db.get_bind(clause=insert(mdl.User)) is primary
+        assert db.get_bind(clause=select(mdl.User.id)) is primary
+        assert len(connections) == 1
+    finally:
+        db.close()
+        replica.close()
+
+
+def test_routing_session_reads_from_the_primary_without_a_replica(test_db: Session):
+    """
+    This test ensures that reads go to the primary when no replica can be
+    reached, without trying to connect again on every read.
+    """
+    primary = test_db.get_bind()
+    attempts = []
+    replica = database.ReplicaLink(lambda: attempts.append(1))
+    db = database.RoutingSession(bind=primary, info={database.REPLICA: replica})
+
+    try:
+        assert db.get_bind(clause=select(mdl.User.id)) is primary
+        assert db.get_bind(clause=select(mdl.User.id)) is primary
+        assert len(attempts) == 1
+    finally:
+        db.close()
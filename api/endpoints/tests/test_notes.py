@@ -2,20 +2,35 @@
 test_notes.py
 Tests for the user endpoints
 """
+import asyncio
+import json
 from uuid import uuid4
 
+import pytest
+
 # Package Imports
 from fastapi.testclient import TestClient
-from fastapi import status
+from fastapi import HTTPException, Request, status
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, event, select
 
 # Local Imports
-from api.utils.auth import AuthHandler
+from api.utils.auth import AuthHandler, Principal
 import api.meta.database.factories as fac
 import api.meta.database.model as mdl
 from api.config import get_settings
-from api.meta.constants.errors import NOTE_DOES_NOT_EXIST, USER_NOT_AUTHORIZED
+from api.endpoints import notes, user
+from api.utils import database, templates
+from api.meta.constants import schemas
+from api.meta.constants.errors import (
+    INVALID_CURSOR,
+    INVALID_NOTE_BATCH,
+    NOTE_DOES_NOT_EXIST,
+    NOTE_RENDER_BUSY,
+    NOTE_RENDER_TIMEOUT,
+    NOTE_RENDER_TOO_LARGE,
+    USER_NOT_AUTHORIZED,
+)
 
 # -------------------------
 settings = get_settings()
@@ -59,6 +74,144 @@ def test_note_has_been_created_successfully(client: TestClient, test_db: Session
     assert query is not None
 
 
+def test_note_lifecycle(any_client: TestClient):
+    """
+    This test ensures that creating, listing, viewing and deleting notes
+    behave the same through the sync and the async routers.
+    """
+    credentials = {"username": "lifecycle", "password": "secret"}
+    response = any_client.post("/user/signup", json=credentials)
+    assert response.status_code == status.HTTP_201_CREATED
+    token = any_client.post("/user/login", json=credentials).json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    for title in ["first", "second"]:
+        params = {"title": title, "description": "{{ 7*7 }}"}
+        response = any_client.post("/notes", json=params, headers=headers)
+        assert response.status_code == status.HTTP_201_CREATED
+
+    response = any_client.get("/notes", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    listed = response.json()["notes"]
+    assert [note["title"] for note in listed] == ["second", "first"]
+
+    note_id = listed[0]["id"]
+    response = any_client.get(f"/notes/{note_id}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"id": note_id, "title": "second", "description": "49"}
+
+    response = any_client.get(f"/notes/{note_id}/html", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert "49" in response.text
+
+    response = any_client.delete("/notes", json={"id": note_id}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+
+    response = any_client.get(f"/notes/{note_id}", headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()["detail"]["msg"] == NOTE_DOES_NOT_EXIST
+
+    response = any_client.get("/notes", headers=headers)
+    assert [note["title"] for note in response.json()["notes"]] == ["first"]
+
+
+@pytest.mark.parametrize("copy_threshold", [1000, 1], ids=["insert", "copy"])
+def test_batch_of_notes_created(
+    client: TestClient, test_db: Session, monkeypatch, copy_threshold: int
+):
+    """
+    This test ensures that a batch of notes is created in order, both
+    with the multi-row INSERT and the COPY paths.
+    """
+    monkeypatch.setattr(settings, "BATCH_COPY_THRESHOLD", copy_threshold)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    notes = [
+        {"title": f"note {index}", "description": f"line, with {{{{ {index} }}}}"}
+        for index in range(5)
+    ]
+    notes.append({"title": "empty", "description": ""})
+    response = client.post("/notes/batch", json={"notes": notes}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    res_data = response.json()
+    assert res_data["rejected"] == []
+    assert len(res_data["ids"]) == len(notes)
+
+    for note_id, note in zip(res_data["ids"], notes):
+        created = test_db.query(mdl.Note).filter(mdl.Note.id == note_id).one()
+        assert str(created.user_id) == user_id
+        assert created.title == note["title"]
+        assert created.description == note["description"]
+
+
+@pytest.mark.parametrize("copy_threshold", [1000, 1], ids=["insert", "copy"])
+def test_batch_stores_renderings(
+    client: TestClient, test_db: Session, monkeypatch, copy_threshold: int
+):
+    """
+    This test ensures that with RENDER_ON_WRITE a batch stores the rendering
+    of each note, and NULL for a note that doesn't render, on both paths.
+    """
+    monkeypatch.setattr(settings, "BATCH_COPY_THRESHOLD", copy_threshold)
+    monkeypatch.setattr(settings, "RENDER_ON_WRITE", True)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    notes = [
+        {"title": "renders", "description": "{{ 6*7 }}"},
+        {"title": "broken", "description": "{{ 6*"},
+    ]
+    response = client.post("/notes/batch", json={"notes": notes}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    renders, broken = response.json()["ids"]
+
+    created = test_db.get(mdl.Note, renders)
+    assert created.rendered_description == "42"
+    assert created.rendered_version == templates.RENDERER_VERSION
+    created = test_db.get(mdl.Note, broken)
+    assert created.rendered_description is None
+    assert created.rendered_version is None
+
+
+@pytest.mark.parametrize("all_or_nothing", [True, False])
+def test_batch_with_invalid_notes(
+    client: TestClient, test_db: Session, monkeypatch, all_or_nothing: bool
+):
+    """
+    This test ensures that an invalid note either rejects the whole batch,
+    or is skipped and reported when BATCH_ALL_OR_NOTHING is off.
+    """
+    monkeypatch.setattr(settings, "BATCH_ALL_OR_NOTHING", all_or_nothing)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    notes = [
+        {"title": "fine", "description": "fine"},
+        {"title": "x" * 129, "description": "title too long"},
+    ]
+    response = client.post("/notes/batch", json={"notes": notes}, headers=headers)
+    created = test_db.query(mdl.Note).filter(mdl.Note.user_id == user_id).count()
+
+    if all_or_nothing:
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["detail"]["msg"].startswith(INVALID_NOTE_BATCH)
+        assert created == 0
+    else:
+        assert response.status_code == status.HTTP_201_CREATED
+        res_data = response.json()
+        assert len(res_data["ids"]) == 1
+        assert [reject["index"] for reject in res_data["rejected"]] == [1]
+        assert created == 1
+
+
 def test_note_has_been_deleted_successfully(client: TestClient, test_db: Session):
     """
     This test ensures that the note has been deleted successfully
@@ -92,6 +245,36 @@ def test_note_has_been_deleted_successfully(client: TestClient, test_db: Session
     assert query is None
 
 
+def test_bulk_delete_notes(client: TestClient, test_db: Session):
+    """
+    This test ensures that several notes are deleted in one request,
+    and that ids of other users' notes are reported as not found.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, other_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.User_factory.create(id=other_id)
+    kept, deleted, others = str(uuid4()), [str(uuid4()), str(uuid4())], str(uuid4())
+    for note_id in [kept] + deleted:
+        fac.Note_factory.create(id=note_id, user_id=user_id)
+    fac.Note_factory.create(id=others, user_id=other_id)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    payload = {"ids": deleted + [others]}
+    response = client.delete("/notes/bulk", json=payload, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"deleted": deleted, "not_found": [others]}
+
+    remaining = {
+        str(note.id)
+        for note in test_db.query(mdl.Note.id).filter(
+            mdl.Note.id.in_([kept, others] + deleted)
+        )
+    }
+    assert remaining == {kept, others}
+
+
 def test_fetch_all_notes(client: TestClient, test_db: Session):
     """
     This ensures that all the notes of a given user are sent.
@@ -150,7 +333,131 @@ def test_fetch_all_notes_attacker_user(client: TestClient, test_db: Session):
     assert response.status_code == status.HTTP_200_OK
 
     # assert that 5 items were grabbed from the user monsec
-    assert len(res_data) == 5
+    assert len(res_data["notes"]) == 5
+
+
+def test_fetch_notes_by_pages(client: TestClient, test_db: Session):
+    """
+    This test ensures that following next_cursor walks through every note
+    once, newest first.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    for _ in range(5):
+        fac.Note_factory.create(user_id=user_id)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    params = {"limit": 2}
+    pages = []
+    while True:
+        response = client.get("/notes", headers=headers, params=params)
+        assert response.status_code == status.HTTP_200_OK
+        res_data = response.json()
+        pages.append(res_data["notes"])
+        if res_data["next_cursor"] is None:
+            break
+        params["cursor"] = res_data["next_cursor"]
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+
+    expected = (
+        test_db.query(mdl.Note.id)
+        .filter(mdl.Note.user_id == user_id)
+        .order_by(mdl.Note.created_date.desc(), mdl.Note.id.desc())
+        .all()
+    )
+    ids = [note["id"] for page in pages for note in page]
+    assert ids == [str(note.id) for note in expected]
+
+
+def test_export_notes_as_ndjson(client: TestClient, test_db: Session, monkeypatch):
+    """
+    This test ensures that the export streams every note of the user,
+    one JSON document per line, across several cursor batches.
+    """
+    monkeypatch.setattr(settings, "EXPORT_BATCH_SIZE", 2)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, other_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.User_factory.create(id=other_id)
+    notes = [fac.Note_factory.create(user_id=user_id) for _ in range(5)]
+    fac.Note_factory.create(user_id=other_id)
+    test_db.flush()
+    note_ids = {str(note.id) for note in notes}
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get("/notes/export", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert {line["id"] for line in lines} == note_ids
+    assert all(line["description"] for line in lines)
+
+
+def test_export_stops_when_the_client_goes_away(test_db: Session):
+    """
+    This test ensures that the export stops reading notes once the client
+    has disconnected, and closes its cursor and session on its own.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user = fac.User_factory.create(id=str(uuid4()))
+    fac.Note_factory.create(user_id=user.id)
+    test_db.flush()
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def read(response) -> list:
+        return [chunk async for chunk in response.body_iterator]
+
+    request = Request({"type": "http", "method": "GET", "headers": []}, receive)
+    principal = Principal(user.id, user.username, user.is_admin)
+    response = notes.export_notes(request, user=principal, db=test_db)
+    assert test_db.in_transaction()
+
+    assert asyncio.run(read(response)) == []
+    assert not test_db.in_transaction()
+
+
+def test_fetch_notes_skips_the_orm(client: TestClient, test_db: Session):
+    """
+    This test ensures that listing notes reads plain rows
+    instead of loading Note objects into the session.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    for _ in range(3):
+        fac.Note_factory.create(user_id=user_id)
+    test_db.flush()
+    test_db.expunge_all()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get("/notes", headers=headers)
+    assert len(response.json()["notes"]) == 3
+
+    loaded = [obj for obj in test_db.identity_map.values() if isinstance(obj, mdl.Note)]
+    assert loaded == []
+
+
+def test_fetch_notes_invalid_cursor(client: TestClient, test_db: Session):
+    """
+    This test ensures that a tampered cursor is rejected.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get("/notes", headers=headers, params={"cursor": "nope"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"]["msg"] == INVALID_CURSOR
 
 
 def test_attacker_attemps_to_delete_other_user_note(
@@ -217,6 +524,37 @@ def test_attacker_attempts_to_get_another_user_note(
     assert response.status_code == status.HTTP_200_OK
 
 
+def test_view_note_loads_the_owner_in_one_query(client: TestClient, test_db: Session):
+    """
+    This test ensures that viewing a note fetches the note and its owner
+    together, next to the query that authenticates the user.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(id=note_id, user_id=user_id)
+    test_db.flush()
+    test_db.expunge_all()
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = test_db.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        headers = {"Authorization": f"Bearer {login(user_id)}"}
+        response = client.get(f"/notes/{note_id}", headers=headers)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    assert response.status_code == status.HTTP_200_OK
+    selects = [statement for statement in statements if statement.startswith("SELECT")]
+    assert len(selects) == 2
+
+
 def test_an_unprivileged_attacker_attempts_to_get_an_admin_secrets(
     client: TestClient, test_db: Session
 ):
@@ -286,3 +624,452 @@ def test_a_privileged_attacker_attempts_to_get_an_admin_notes(
     assert response.status_code == status.HTTP_200_OK
     assert "DO NOT READ" in res_data["title"]
     assert "I AM THE ADMIN, I HAVE POWER!" in res_data["description"]
+
+
+def test_async_routers_mirror_sync_routers():
+    """
+    This test ensures that DATABASE_ASYNC serves exactly the same
+    endpoints as the default sync routers.
+    """
+
+    def routes(router):
+        return {(route.path, tuple(sorted(route.methods))) for route in router.routes}
+
+    assert routes(notes.async_router) == routes(notes.router)
+    assert routes(user.async_router) == routes(user.router)
+
+
+def test_repeated_requests_hit_the_statement_cache(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that the hot queries are compiled once, and served
+    from the statement cache on the next request.
+    """
+    monkeypatch.setattr(settings, "NOTE_PAGE_CACHE", False)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(id=note_id, user_id=user_id)
+    test_db.flush()
+
+    database.watch_statement_cache(test_db.get_bind())
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    client.get(f"/notes/{note_id}", headers=headers)
+    client.get("/notes", headers=headers)
+
+    before = database.statement_cache_stats()
+    assert client.get(f"/notes/{note_id}", headers=headers).status_code == 200
+    assert client.get("/notes", headers=headers).status_code == 200
+    after = database.statement_cache_stats()
+
+    # the note, the version of the list and the page, the principal comes
+    # from its own cache
+    assert after["hits"] - before["hits"] == 3
+    assert after["misses"] == before["misses"]
+
+
+@pytest.mark.parametrize("processes", [0, 1], ids=["threads", "processes"])
+def test_note_template_is_compiled_once(processes: int):
+    """
+    This test ensures that rendering a description again reuses the
+    template compiled by the first render, and that the renderer counts
+    the template cache lookups made wherever the renders ran.
+    """
+    renderer = templates.NoteRenderer(processes=processes)
+    source = f"{{{{ 7*7 }}}}{{# {uuid4()} #}}"
+
+    try:
+        for _ in range(2):
+            assert renderer.render(source) == "49"
+    finally:
+        renderer.shutdown()
+
+    stats = renderer.stats()
+    assert stats["template_misses"] == 1
+    assert stats["template_hits"] == 1
+    assert stats["template_hit_ratio"] == 0.5
+
+
+@pytest.mark.parametrize(
+    "description, error",
+    [
+        ("{% for i in range(10**10) %}{% endfor %}", NOTE_RENDER_TIMEOUT),
+        ("{% for i in range(10**4) %}0123456789{% endfor %}", NOTE_RENDER_TOO_LARGE),
+    ],
+    ids=["cpu", "output"],
+)
+def test_render_budgets(
+    client: TestClient, test_db: Session, monkeypatch, description: str, error: str
+):
+    """
+    This test ensures that a note exceeding the render budgets gets an
+    error instead of holding a worker, and that the next note renders.
+    """
+    monkeypatch.setattr(templates.note_renderer, "cpu_seconds", 0.2)
+    monkeypatch.setattr(templates.note_renderer, "max_output", 1000)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id, next_id = str(uuid4()), str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(id=note_id, user_id=user_id, description=description)
+    fac.Note_factory.create(id=next_id, user_id=user_id, description="{{ 7*7 }}")
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get(f"/notes/{note_id}", headers=headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert response.json()["detail"]["msg"] == error
+
+    response = client.get(f"/notes/{next_id}", headers=headers)
+    assert response.json()["description"] == "49"
+
+
+def test_looping_notes_dont_time_out_the_next_render():
+    """
+    This test ensures that a note queued behind looping ones still renders
+    in time, and that a note which couldn't is turned away with a 429 up
+    front instead of waiting for a timeout.
+    """
+    renderer = templates.NoteRenderer(
+        processes=1, queue_size=64, cpu_seconds=0.2, timeout=2.0
+    )
+    loop = "{% for i in range(10**10) %}{% endfor %}"
+
+    async def render(description: str):
+        try:
+            return await renderer.render_async(description)
+        except HTTPException as error:
+            return error
+
+    async def burst():
+        # submitted in this order, 6 looping notes, one to render, 6 more
+        # looping ones and a last one to render
+        descriptions = [loop] * 6 + ["{{ 7*7 }}"] + [loop] * 6 + ["{{ 6*7 }}"]
+        return await asyncio.gather(*map(render, descriptions))
+
+    try:
+        # a booted render process, its startup isn't part of the budget
+        assert renderer.render("warm") == "warm"
+        # 2 seconds hold 10 renders of 0.2 CPU seconds
+        assert renderer.limit == 10
+        results = asyncio.run(burst())
+    finally:
+        renderer.shutdown()
+
+    assert results[6] == "49"
+    refused = results[-1]
+    assert refused.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert refused.detail == NOTE_RENDER_BUSY
+    looped = results[:6] + results[7:-1]
+    assert [error.status_code for error in looped] == [422] * 9 + [429] * 3
+
+
+def test_a_killed_render_only_fails_itself():
+    """
+    This test ensures that a render stuck in C code, which RLIMIT_CPU kills
+    along with its process, doesn't fail the renders queued behind it, they
+    run again on a fresh pool.
+    """
+    renderer = templates.NoteRenderer(
+        processes=1, queue_size=64, cpu_seconds=0.2, timeout=5.0
+    )
+
+    async def render(description: str):
+        try:
+            return await renderer.render_async(description)
+        except HTTPException as error:
+            return error
+
+    async def burst():
+        # the power is computed in C, the CPU timer can't interrupt it
+        descriptions = ["{{ 10**(10**7) }}"] + ["{{ 7*7 }}"] * 3
+        return await asyncio.gather(*map(render, descriptions))
+
+    try:
+        assert renderer.render("warm") == "warm"
+        killed, *rendered = asyncio.run(burst())
+    finally:
+        renderer.shutdown()
+
+    assert killed.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert rendered == ["49"] * 3
+    assert renderer.stats()["retried"] == 3
+
+
+def test_views_render_without_holding_a_connection(test_db: Session, monkeypatch):
+    """
+    This test ensures that a view gives its database connections back
+    before rendering, a slow render doesn't keep one out of the pool.
+    """
+    primary = test_db.get_bind()
+    replica = database.ReplicaLink(primary.connect)
+    db = database.RoutingSession(bind=primary, info={database.REPLICA: replica})
+    held = []
+
+    async def render_async(description: str) -> str:
+        held.append((db.in_transaction(), replica.connection))
+        return "42"
+
+    monkeypatch.setattr(templates.note_renderer, "render_async", render_async)
+    try:
+        db.execute(select(mdl.Note.id)).all()
+        assert replica.connection is not None
+
+        note = mdl.Note(id=uuid4(), title="Slow", description="{{ 6*7 }}")
+        described = asyncio.run(notes.describe_note(db, note))
+        assert described["description"] == "42"
+        assert held == [(False, None)]
+    finally:
+        db.close()
+        replica.close()
+
+
+def test_rendering_is_stored_on_write(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that with RENDER_ON_WRITE a note keeps its rendered
+    description, views serve it, and an outdated rendering is redone.
+    """
+    monkeypatch.setattr(settings, "RENDER_ON_WRITE", True)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    params = {"title": "Rendered", "description": "{{ 6*7 }}"}
+    response = client.post("/notes", json=params, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    note = test_db.query(mdl.Note).filter(mdl.Note.user_id == user_id).one()
+    assert note.rendered_description == "42"
+    assert note.rendered_version == templates.RENDERER_VERSION
+
+    # the stored copy is served as is
+    note.rendered_description = "stored"
+    test_db.flush()
+    response = client.get(f"/notes/{note.id}", headers=headers)
+    assert response.json()["description"] == "stored"
+
+    # a rendering of another version is redone and stored again
+    note.rendered_version = templates.RENDERER_VERSION - 1
+    test_db.flush()
+    response = client.get(f"/notes/{note.id}", headers=headers)
+    assert response.json()["description"] == "42"
+    test_db.refresh(note)
+    assert note.rendered_version == templates.RENDERER_VERSION
+
+    # editing the description drops the rendering made for the old one
+    note.description = "{{ 7*7 }}"
+    assert note.rendered_description is None
+
+
+def test_view_note_as_html(client: TestClient, test_db: Session):
+    """
+    This test ensures that a note is served as an HTML page, with its
+    description rendered and its title escaped.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(
+        id=note_id, user_id=user_id, title="<b>bold</b>", description="{{ 7*7 }}"
+    )
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get(f"/notes/{note_id}/html", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/html")
+    assert "<h1>&lt;b&gt;bold&lt;/b&gt;</h1>" in response.text
+    assert '<div class="description">49</div>' in response.text
+
+    response = client.get(f"/notes/{uuid4()}/html", headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_page_templates_are_compiled_once_per_deploy(tmp_path):
+    """
+    This test ensures that the compiled page templates are kept on disk,
+    and that a new environment loads them instead of compiling again.
+    """
+    templates.build_page_env(str(tmp_path)).get_template(settings.NOTE_TEMPLATE)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    env = templates.build_page_env(str(tmp_path))
+    env.compile = None  # fails if the template source is compiled
+    env.get_template(settings.NOTE_TEMPLATE)
+
+
+def test_shaped_responses_match_their_models(client: TestClient, test_db: Session):
+    """
+    This test ensures that the responses sent without pydantic validation
+    still parse as their response_model.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(id=note_id, user_id=user_id)
+    fac.Note_factory.create(user_id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    response = client.get("/notes", params={"limit": 1}, headers=headers)
+    page = schemas.NotePage.parse_raw(response.content)
+    assert response.json() == json.loads(page.json())
+    assert page.next_cursor is not None
+
+    response = client.get(f"/notes/{note_id}", headers=headers)
+    note = schemas.NoteObject.parse_raw(response.content)
+    assert response.json() == json.loads(note.json())
+
+
+def test_unchanged_notes_are_not_modified(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that polling with the ETag of the previous response
+    gets a 304 from the version query alone, until a note changes.
+    """
+    # the notes are changed behind the endpoints, which the page cache can't see
+    monkeypatch.setattr(settings, "NOTE_PAGE_CACHE", False)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.Note_factory._meta.sqlalchemy_session = test_db
+    user_id, note_id = str(uuid4()), str(uuid4())
+    fac.User_factory.create(id=user_id)
+    fac.Note_factory.create(id=note_id, user_id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    page_etag = client.get("/notes", headers=headers).headers["ETag"]
+    note_etag = client.get(f"/notes/{note_id}", headers=headers).headers["ETag"]
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = test_db.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        response = client.get("/notes", headers={**headers, "If-None-Match": page_etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        response = client.get(
+            f"/notes/{note_id}", headers={**headers, "If-None-Match": note_etag}
+        )
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    # one version query each, no note is loaded
+    assert len(statements) == 2
+    assert all("description" not in statement for statement in statements)
+
+    # a new note changes the list, an edit changes the note
+    fac.Note_factory.create(user_id=user_id)
+    note = test_db.get(mdl.Note, note_id)
+    note.title = "edited"
+    test_db.flush()
+
+    response = client.get("/notes", headers={**headers, "If-None-Match": page_etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()["notes"]) == 2
+    response = client.get(
+        f"/notes/{note_id}", headers={**headers, "If-None-Match": note_etag}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["title"] == "edited"
+    assert response.headers["ETag"] != note_etag
+
+
+def test_note_pages_are_cached_until_a_write(client: TestClient, test_db: Session):
+    """
+    This test ensures that a repeated page of notes is served from the page
+    cache, and that creating or deleting a note of the user retires it.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    params = {"title": "cached", "description": "page"}
+    cache = notes.note_pages
+
+    def titles():
+        response = client.get("/notes", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        return [note["title"] for note in response.json()["notes"]]
+
+    assert client.post("/notes", json=params, headers=headers).status_code == 201
+    misses = cache.misses
+    assert titles() == ["cached"]
+    hits = cache.hits
+    assert titles() == ["cached"]
+    assert cache.hits - hits == 1
+    assert cache.misses - misses == 1
+
+    # the cached page carries its ETag
+    etag = client.get("/notes", headers=headers).headers["ETag"]
+    response = client.get("/notes", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    assert client.post("/notes", json=params, headers=headers).status_code == 201
+    assert titles() == ["cached", "cached"]
+
+    note_id = test_db.query(mdl.Note.id).filter(mdl.Note.user_id == user_id).first()[0]
+    response = client.delete("/notes", json={"id": str(note_id)}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert titles() == ["cached"]
+
+
+def test_note_pages_read_from_a_replica_are_not_cached(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that a page read from a replica, which may not have
+    the latest write yet, isn't kept in the page cache.
+    """
+    monkeypatch.setattr(notes, "reads_from_replica", lambda db: True)
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    test_db.flush()
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    misses = notes.note_pages.misses
+    for _ in range(2):
+        response = client.get("/notes", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+    assert notes.note_pages.misses - misses == 2
+    assert len(notes.note_pages) == 0
+
+
+def test_note_pages_are_bounded_by_bytes(monkeypatch):
+    """
+    This test ensures that the page cache evicts its oldest pages once their
+    bodies add up to more than its size in bytes.
+    """
+    cache = notes.note_pages
+    monkeypatch.setattr(cache, "maxsize", 10)
+    pages = {
+        key: notes.CachedPage('"etag"', b"x" * size)
+        for key, size in [("a", 5), ("b", 4), ("c", 3), ("d", 11)]
+    }
+
+    cache.set("a", pages["a"])
+    cache.set("b", pages["b"])
+    cache.set("c", pages["c"])
+    assert "a" not in cache and cache.weight == 7
+
+    # a page bigger than the whole cache isn't kept
+    cache.set("d", pages["d"])
+    assert "d" not in cache and cache.weight == 7
+
+    cache.set("b", notes.CachedPage('"etag"', b"x"))
+    assert cache.get("c") == pages["c"] and cache.weight == 4
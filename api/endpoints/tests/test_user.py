@@ -2,20 +2,37 @@
 test_user.py
 Tests for the user endpoints
 """
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import sleep, time
 from uuid import uuid4, UUID
 
 # Package Imports
+import jwt
+import pytest
+from fastapi import HTTPException
+from passlib.context import CryptContext
 from fastapi.testclient import TestClient
 from fastapi import status
-from api.utils.auth import AuthHandler
+from api.utils.auth import AuthHandler, Principal, principals
 from sqlalchemy.orm.session import Session
 
 # Local Imports
-from api.meta.constants.errors import INVALID_USER_PASSWORD, USERNAME_TAKEN
+from api.meta.constants.errors import (
+    INVALID_USER_PASSWORD,
+    PASSWORD_HASHING_BUSY,
+    SIGNATURE_EXPIRED,
+    USERNAME_TAKEN,
+)
 from api.meta.constants.messages import ACCOUNT_CREATED
 import api.meta.database.model as mdl
 import api.meta.database.factories as fac
 from api.config import get_settings
+from api.endpoints import user
+from api.utils.cache import LRUCache
+from api.utils.hashing import PasswordHasher, needs_rehash, password_hasher
 
 settings = get_settings()
 
@@ -49,6 +66,7 @@ def test_user_creation_same_user(client: TestClient, test_db: Session):
     fac.User_factory._meta.sqlalchemy_session = test_db
     user_id = uuid4()
     fac.User_factory.create(id=user_id, username="monsec")
+    test_db.flush()
 
     # try to create the same user
     params = {"username": "monsec", "password": "123"}
@@ -73,6 +91,172 @@ def test_user_creation_same_user(client: TestClient, test_db: Session):
     assert query == 1
 
 
+def test_taken_username_is_refused_before_hashing(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that signup finds a taken username, ignoring case,
+    from its single INSERT, and refuses it without hashing the password
+    the next time.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    fac.User_factory.create(id=uuid4(), username="monsec")
+    test_db.flush()
+
+    params = {"username": "MonSec", "password": "123"}
+    response = client.post("/user/signup", json=params)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"]["msg"] == USERNAME_TAKEN
+
+    def no_hashing(function, *args):
+        raise AssertionError("the password should not be hashed")
+
+    monkeypatch.setattr(password_hasher, "_submit", no_hashing)
+    response = client.post("/user/signup", json=params)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"]["msg"] == USERNAME_TAKEN
+
+
+def test_new_username_is_refused_before_hashing(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that a username is known as taken as soon as its
+    signup succeeds, a repeated signup in any case is refused without hashing.
+    """
+    params = {"username": "newcomer", "password": "123"}
+    response = client.post("/user/signup", json=params)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    def no_hashing(function, *args):
+        raise AssertionError("the password should not be hashed")
+
+    monkeypatch.setattr(password_hasher, "_submit", no_hashing)
+    response = client.post("/user/signup", json={**params, "username": "NewComer"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"]["msg"] == USERNAME_TAKEN
+
+
+def test_taken_usernames_ignore_case():
+    """
+    This test ensures that the taken usernames are remembered the way the
+    unique index compares them, ignoring case.
+    """
+    user.remember_taken_username("Twin")
+    with pytest.raises(HTTPException) as error:
+        user.refuse_known_username("tWIN")
+    assert error.value.detail == USERNAME_TAKEN
+
+
+def test_signup_is_turned_away_when_hashing_is_saturated(
+    client: TestClient, monkeypatch
+):
+    """
+    This test ensures that signups get a 429 with a Retry-After once the
+    password hashing queue is full, instead of waiting in line.
+    """
+    monkeypatch.setattr(password_hasher, "pending", password_hasher.limit)
+
+    params = {"username": "queued", "password": "123"}
+    response = client.post("/user/signup", json=params)
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response.headers["Retry-After"]
+    assert response.json()["detail"]["msg"] == PASSWORD_HASHING_BUSY
+
+
+def test_note_routes_answer_while_hashing_is_saturated(
+    client: TestClient, test_db: Session, monkeypatch
+):
+    """
+    This test ensures that signups waiting for bcrypt hold no thread of the
+    threadpool, the sync note routes still answer while more signups than
+    it has threads are in flight.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    user_id = str(uuid4())
+    fac.User_factory.create(id=user_id)
+    test_db.flush()
+
+    # hashes that never finish until the test lets them fail
+    stuck = []
+
+    def stuck_submit(function, *args):
+        password_hasher._acquire()
+        future = Future()
+        future.executor = None
+        future.add_done_callback(password_hasher._release)
+        stuck.append(future)
+        return future
+
+    monkeypatch.setattr(password_hasher, "_submit", stuck_submit)
+    # more than the 40 threads of Starlette's threadpool
+    burst = 50
+    monkeypatch.setattr(password_hasher, "limit", burst)
+
+    headers = {"Authorization": f"Bearer {login(user_id)}"}
+    with ThreadPoolExecutor(burst + 1) as executor:
+        signups = [
+            executor.submit(
+                client.post,
+                "/user/signup",
+                json={"username": f"burst{i}", "password": "pw"},
+            )
+            for i in range(burst)
+        ]
+        deadline = time() + 10
+        while len(stuck) < burst and time() < deadline:
+            sleep(0.01)
+
+        try:
+            notes = executor.submit(client.get, "/notes", headers=headers)
+            assert notes.result(timeout=5).status_code == status.HTTP_200_OK
+            assert len(stuck) == burst
+        finally:
+            while not all(signup.done() for signup in signups):
+                for future in list(stuck):
+                    if not future.done():
+                        future.set_exception(BrokenProcessPool())
+                sleep(0.01)
+
+    assert all(
+        signup.result().status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        for signup in signups
+    )
+
+
+def test_password_hasher_async_api():
+    """
+    This test ensures that the hashing service can be awaited, and that
+    every call leaves the queue once it's done.
+    """
+    hasher = PasswordHasher(processes=0, queue_size=1)
+
+    async def hash_and_verify():
+        hashed = await hasher.hash_async("secret")
+        return await hasher.verify_async("secret", hashed)
+
+    try:
+        assert asyncio.run(hash_and_verify()) is True
+    finally:
+        hasher.shutdown()
+    assert hasher.pending == 0
+    assert hasher.completed == 2
+
+
+def test_process_pools_share_the_cores_between_web_workers(monkeypatch):
+    """
+    This test ensures that by default the process pools of the web workers
+    together start about one process per core, and at least one each.
+    """
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setattr(settings, "WEB_CONCURRENCY", 4)
+    assert PasswordHasher().processes == 2
+    assert PasswordHasher(processes=3).processes == 3
+
+    monkeypatch.setattr(settings, "WEB_CONCURRENCY", 16)
+    assert PasswordHasher().processes == 1
+
+
 def test_user_login(client: TestClient, test_db: Session):
     """
     This test ensures that once the user has been registered, it can access
@@ -93,6 +277,110 @@ def test_user_login(client: TestClient, test_db: Session):
     assert token["id"] == user_id
 
 
+def test_login_rehashes_outdated_passwords(client: TestClient, test_db: Session):
+    """
+    This test ensures that logging in with a password hashed with other
+    BCRYPT_ROUNDS stores a new hash made with the current ones.
+    """
+    fac.User_factory._meta.sqlalchemy_session = test_db
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=4).hash("pw")
+    user = fac.User_factory.create(id=uuid4(), username="rehash", password=old_hash)
+    test_db.flush()
+    assert needs_rehash(old_hash)
+
+    response = client.post("/user/login", json={"username": "rehash", "password": "pw"})
+    assert response.status_code == status.HTTP_200_OK
+
+    test_db.refresh(user)
+    assert user.password != old_hash
+    assert not needs_rehash(user.password)
+    assert password_hasher.verify("pw", user.password)
+
+
+def test_verified_tokens_are_cached_until_they_expire():
+    """
+    This test ensures that a token is only verified once, and that its
+    cached payload is dropped when the token expires.
+    """
+    handler = AuthHandler()
+    handler.verified_tokens = LRUCache(10)
+    payload = {"id": str(uuid4()), "exp": int(time()) + 1}
+    token = jwt.encode(payload, key=handler.secret, algorithm="HS256")
+
+    assert handler.decode_token(token) == payload
+    assert handler.decode_token(token) == payload
+    assert handler.verified_tokens.hits == 1
+    assert handler.verified_tokens.misses == 1
+
+    sleep(2)
+    with pytest.raises(HTTPException) as error:
+        handler.decode_token(token)
+    assert error.value.detail == SIGNATURE_EXPIRED
+
+
+def test_tokens_without_expiry_are_not_cached():
+    """
+    This test ensures that a signed token without an exp claim still
+    decodes, without being cached.
+    """
+    handler = AuthHandler()
+    handler.verified_tokens = LRUCache(10)
+    payload = {"id": str(uuid4())}
+    token = jwt.encode(payload, key=handler.secret, algorithm="HS256")
+
+    assert handler.decode_token(token) == payload
+    assert len(handler.verified_tokens) == 0
+
+
+def test_principal_cache_is_invalidated_when_the_user_changes(test_db: Session):
+    """
+    This test ensures that a cached principal is dropped once a change
+    or the deletion of its user is committed.
+    """
+    session = Session(bind=test_db.get_bind())
+    user = mdl.User(username=f"principal-{uuid4()}", password="x")
+    session.add(user)
+    session.commit()
+    user_id = str(user.id)
+
+    try:
+        principals.set(user_id, Principal(user.id, user.username, False))
+        user.is_admin = True
+        session.flush()
+        assert principals.get(user_id) is not None
+        session.commit()
+        assert principals.get(user_id) is None
+
+        principals.set(user_id, Principal(user.id, user.username, True))
+    finally:
+        session.delete(user)
+        session.commit()
+        session.close()
+    assert principals.get(user_id) is None
+
+
+def test_signup_and_login(any_client: TestClient):
+    """
+    This test ensures that signing up, refusing a taken username and logging
+    in behave the same through the sync and the async routers.
+    """
+    params = {"username": "twin", "password": "supersecret"}
+    response = any_client.post("/user/signup", json=params)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["msg"] == ACCOUNT_CREATED
+
+    response = any_client.post("/user/signup", json={**params, "username": "TWIN"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"]["msg"] == USERNAME_TAKEN
+
+    response = any_client.post("/user/login", json=params)
+    assert response.status_code == status.HTTP_200_OK
+    assert AuthHandler().decode_token(response.json()["token"])["id"]
+
+    response = any_client.post("/user/login", json={**params, "password": "123"})
+    assert response.json()["detail"]["msg"] == INVALID_USER_PASSWORD
+
+
 def test_user_login_wrong_password(client: TestClient):
     """
     This test ensures that wrong passwords will return an error
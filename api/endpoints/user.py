@@ -4,25 +4,31 @@ Endpoints for creating, viewing, deleting and managing users.
 """
 
 # System Imports
+import logging
 from uuid import UUID, uuid4
 
 # Package Imports
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Query
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 # Local imports
 from api.utils.auth import AuthHandler
 from api.meta.constants.schemas import AuthDetails
-from api.utils.database import get_db
+from api.utils.database import get_db, get_async_db
+from api.utils import metrics
+from api.utils.cache import LRUCache
+from api.utils.hashing import needs_rehash, password_hasher
+from api.utils.statements import insert_user, update_password, user_by_username
 from api.config import get_settings
 from api.meta.constants.errors import (
     USERNAME_TAKEN,
     INVALID_USER_PASSWORD,
     SOMETHING_WENT_WRONG,
 )
-from api.meta.database.model import User
 from api.meta.constants.messages import ACCOUNT_CREATED
 
 ####################
@@ -30,12 +36,96 @@ from api.meta.constants.messages import ACCOUNT_CREATED
 ####################
 
 router = APIRouter()
+async_router = APIRouter()
 settings = get_settings()
 auth_handler = AuthHandler()
+logger = logging.getLogger(__name__)
 
+# Usernames this worker has seen taken, refused before hashing the password.
+# Keyed by the lowercased name, like the unique index on lower(username).
+# Entries expire so a username freed by another worker becomes usable again.
+taken_usernames = LRUCache(
+    settings.TAKEN_USERNAMES_CACHE_SIZE, ttl=settings.TAKEN_USERNAMES_CACHE_TTL
+)
+metrics.register("taken_usernames", taken_usernames.stats)
+
+
+def refuse_known_username(username: str) -> None:
+    """Cheap pre-check of the signup, doesn't touch the database"""
+    if username.lower() in taken_usernames:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=USERNAME_TAKEN,
+        )
+
+
+def remember_taken_username(username: str) -> None:
+    taken_usernames.set(username.lower(), True)
+
+
+def refuse_taken_username(username: str) -> None:
+    """The signup INSERT hit an existing username"""
+    remember_taken_username(username)
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=USERNAME_TAKEN,
+    )
 
+
+def store_user(
+    db: Session, username: str, hashed_password: str, is_admin: bool
+) -> Optional[UUID]:
+    """Insert the user and commit, the id is None when the username is taken"""
+    user_id = db.execute(insert_user(username, hashed_password, is_admin)).scalar()
+    db.commit()
+    return user_id
+
+
+def find_user(db: Session, username: str):
+    return db.execute(user_by_username(username)).scalars().one_or_none()
+
+
+def store_password(db: Session, user_id: UUID, old_hash: str, new_hash: str) -> None:
+    try:
+        db.execute(update_password(user_id, old_hash, new_hash))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+async def rehash_password(
+    db: Session, user_id: UUID, password: str, old_hash: str
+) -> None:
+    """
+    Store a hash of the password made with the current settings, runs as a
+    background task of login, which still holds the request session
+    """
+    try:
+        new_hash = await password_hasher.hash_async(password)
+        await run_in_threadpool(store_password, db, user_id, old_hash, new_hash)
+    except Exception:
+        logger.warning("couldn't rehash the password of %s", user_id, exc_info=True)
+
+
+async def rehash_password_async(
+    db: AsyncSession, user_id: UUID, password: str, old_hash: str
+) -> None:
+    """Async version of rehash_password"""
+    try:
+        new_hash = await password_hasher.hash_async(password)
+        await db.execute(update_password(user_id, old_hash, new_hash))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        logger.warning("couldn't rehash the password of %s", user_id, exc_info=True)
+
+
+# signup and login wait for bcrypt in the event loop, a thread of the
+# threadpool is only taken for their queries, so a burst of them can't leave
+# the sync note routes without threads
 @router.post("/signup", status_code=status.HTTP_201_CREATED)
-def create_account(
+async def create_account(
     user_details: AuthDetails,
     db: Session = Depends(get_db),
 ) -> None:
@@ -53,36 +143,22 @@ def create_account(
 
     # avoids creating 2 accounts with the same username
     # this might not avoid entering " monsec" -> "monsec"
-    # check that the user is not in the db
     user_details.username = user_details.username.lower()
-    user_exists = (
-        db.query(User)
-        .filter(
-            User.username == user_details.username,
-        )
-        .one_or_none()
-    )
-    if user_exists:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=USERNAME_TAKEN,
-        )
+    refuse_known_username(user_details.username)
 
     # hash the password and save it
-    hashed_password = auth_handler.get_password_hash(user_details.password)
+    hashed_password = await password_hasher.hash_async(user_details.password)
 
-    # create user
+    # create user, unless the username is taken
     # VULN: shouldn't pass is_admin here (param injection)
-    new_user = User(
-        username=user_details.username,
-        password=hashed_password,
-        is_admin=user_details.is_admin,  # This should be patched
-    )
-
-    # add user to the db
     try:
-        db.add(new_user)
-        db.commit()
+        user_id = await run_in_threadpool(
+            store_user,
+            db,
+            user_details.username,
+            hashed_password,
+            user_details.is_admin,  # This should be patched
+        )
 
     # if somethingwent wrong raise exception
     except Exception:
@@ -91,11 +167,20 @@ def create_account(
             detail=SOMETHING_WENT_WRONG,
         )
 
+    if user_id is None:
+        refuse_taken_username(user_details.username)
+
+    # a second signup of the name is refused before bcrypt
+    remember_taken_username(user_details.username)
     return {"msg": ACCOUNT_CREATED}
 
 
 @router.post("/login")
-def login(auth_details: AuthDetails, db: Session = Depends(get_db)) -> dict:
+async def login(
+    auth_details: AuthDetails,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+) -> dict:
     """
     This endpoint logins the user given a username and a password
     in a json payload.
@@ -108,17 +193,11 @@ def login(auth_details: AuthDetails, db: Session = Depends(get_db)) -> dict:
     """
 
     # get user
-    user = (
-        db.query(User)
-        .filter(
-            User.username == auth_details.username.lower(),
-        )
-        .one_or_none()
-    )
+    user = await run_in_threadpool(find_user, db, auth_details.username)
 
     # if the username or the password are not valid
     # raise exception
-    if user is None or not auth_handler.verify_password(
+    if user is None or not await password_hasher.verify_async(
         auth_details.password, user.password
     ):
         raise HTTPException(
@@ -126,7 +205,86 @@ def login(auth_details: AuthDetails, db: Session = Depends(get_db)) -> dict:
             detail=INVALID_USER_PASSWORD,
         )
 
+    # hashes made with older BCRYPT_ROUNDS are redone once the response is sent
+    if needs_rehash(user.password):
+        background_tasks.add_task(
+            rehash_password, db, user.id, auth_details.password, user.password
+        )
+
     # else: return token
     token = auth_handler.encode_token(str(user.id))
 
     return {"token": token}
+
+
+####################
+# Async handlers
+####################
+# Same endpoints as above, served instead of them when DATABASE_ASYNC is set.
+
+
+@async_router.post("/signup", status_code=status.HTTP_201_CREATED)
+async def create_account_async(
+    user_details: AuthDetails,
+    db: AsyncSession = Depends(get_async_db),
+) -> None:
+    """Async version of create_account"""
+
+    user_details.username = user_details.username.lower()
+    refuse_known_username(user_details.username)
+
+    hashed_password = await password_hasher.hash_async(user_details.password)
+
+    # VULN: shouldn't pass is_admin here (param injection)
+    try:
+        result = await db.execute(
+            insert_user(
+                user_details.username,
+                hashed_password,
+                user_details.is_admin,  # This should be patched
+            )
+        )
+        user_id = result.scalar()
+        await db.commit()
+
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=SOMETHING_WENT_WRONG,
+        )
+
+    if user_id is None:
+        refuse_taken_username(user_details.username)
+
+    # a second signup of the name is refused before bcrypt
+    remember_taken_username(user_details.username)
+    return {"msg": ACCOUNT_CREATED}
+
+
+@async_router.post("/login")
+async def login_async(
+    auth_details: AuthDetails,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
+) -> dict:
+    """Async version of login"""
+
+    result = await db.execute(user_by_username(auth_details.username))
+    user = result.scalars().one_or_none()
+
+    if user is None or not await password_hasher.verify_async(
+        auth_details.password, user.password
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=INVALID_USER_PASSWORD,
+        )
+
+    if needs_rehash(user.password):
+        background_tasks.add_task(
+            rehash_password_async, db, user.id, auth_details.password, user.password
+        )
+
+    token = auth_handler.encode_token(str(user.id))
+
+    return {"token": token}
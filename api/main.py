@@ -12,6 +12,10 @@ from pydantic import BaseModel, Field
 # Local Imports
 from api.endpoints import user, notes
 from api.config import get_settings
+from api.utils import responses
+from api.utils.database import dispose_engines, dispose_async_engines
+from api.utils.hashing import password_hasher
+from api.utils.templates import get_note_page, note_renderer
 from api.meta.constants.errors import BAD_REQUEST
 
 # ------------------------------
@@ -22,6 +26,7 @@ app = FastAPI(
     title=settings.APP_TITLE,
     description=settings.APP_DESCRIPTION,
     version=settings.APP_VERSION,
+    default_response_class=responses.JSONResponse,
 )
 
 
@@ -61,7 +66,15 @@ async def http_exception_handler(request, exc):
             }
         }
 
-    response = JSONResponse(content=errorDetail, status_code=exc.status_code)
+    # e.g. Retry-After, skipping the ones that aren't header values
+    headers = {
+        name: value
+        for name, value in (getattr(exc, "headers", None) or {}).items()
+        if isinstance(value, str)
+    }
+    response = JSONResponse(
+        content=errorDetail, status_code=exc.status_code, headers=headers
+    )
 
     return response
 
@@ -108,15 +121,44 @@ async def root():
     return {"msg": "Welcome"}
 
 
+@app.on_event("startup")
+def load_page_templates():
+    """Compile the HTML templates before the first request needs them"""
+    get_note_page()
+
+
+@app.on_event("shutdown")
+async def close_database_connections():
+    """Close every pooled database connection when the worker stops"""
+    await dispose_async_engines()
+    dispose_engines()
+
+
+@app.on_event("shutdown")
+def stop_password_hashing():
+    """Stop the bcrypt worker processes with the worker"""
+    password_hasher.shutdown()
+
+
+@app.on_event("shutdown")
+def stop_note_rendering():
+    """Stop the template rendering processes with the worker"""
+    note_renderer.shutdown()
+
+
+# DATABASE_ASYNC swaps every router for its AsyncSession based twin
+user_router = user.async_router if settings.DATABASE_ASYNC else user.router
+notes_router = notes.async_router if settings.DATABASE_ASYNC else notes.router
+
 app.include_router(
-    user.router,
+    user_router,
     prefix="/user",
     tags=["User"],
     responses=DEFAULT_RESPONSE_CODES,
 )
 
 app.include_router(
-    notes.router,
+    notes_router,
     prefix="/notes",
     tags=["Notes"],
     responses=DEFAULT_RESPONSE_CODES,
@@ -9,9 +9,17 @@ USERNAME_TAKEN = "Username already taken"
 
 # LOGIN ERRORS
 INVALID_USER_PASSWORD = "Invalid username and/or password"
+PASSWORD_HASHING_BUSY = "Too many login attempts in progress, retry later"
+PASSWORD_HASHING_UNAVAILABLE = "Password hashing is unavailable, retry later"
 USER_DOES_NOT_EXIST = "User does not exist"
 
 # RESPONSE ERRORS
 SOMETHING_WENT_WRONG = "Something went wrong"
 NOTE_DOES_NOT_EXIST = "Note does not exist"
 USER_NOT_AUTHORIZED = "User not authorized"
+INVALID_CURSOR = "Invalid pagination cursor"
+INVALID_NOTE_BATCH = "Invalid notes in batch"
+NOTE_RENDER_TIMEOUT = "Note took too long to render"
+NOTE_RENDER_TOO_LARGE = "Rendered note is too large"
+NOTE_RENDER_BUSY = "Too many notes being rendered, retry later"
+NOTE_RENDER_UNAVAILABLE = "Note rendering is unavailable, retry later"
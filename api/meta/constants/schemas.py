@@ -1,6 +1,6 @@
 # Package imports
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 from uuid import uuid4, UUID
 from sqlalchemy.orm import relationship
 
@@ -49,6 +49,36 @@ class NotePayload(BaseModel):
     )
 
 
+class NoteBatchPayload(BaseModel):
+    notes: List[NotePayload] = Field(
+        title="The notes to create, in order",
+        min_items=1,
+        max_items=settings.MAX_BATCH_NOTES,
+    )
+
+
+class NoteBatchRejection(BaseModel):
+    index: int = Field(
+        title="Position of the rejected note in the batch",
+        example=3,
+    )
+    msg: str = Field(
+        title="Why the note was rejected",
+        example="title is longer than 128 characters",
+    )
+
+
+class NoteBatchResult(BaseModel):
+    ids: List[UUID] = Field(
+        title="The UUIDs of the created notes, in batch order",
+        example=[uuid4(), uuid4()],
+    )
+    rejected: List[NoteBatchRejection] = Field(
+        title="Notes that were not created, only when BATCH_ALL_OR_NOTHING is off",
+        example=[],
+    )
+
+
 class NoteDeletePayload(BaseModel):
     id: UUID = Field(
         title="The uuid of the note to delete",
@@ -56,6 +86,26 @@ class NoteDeletePayload(BaseModel):
     )
 
 
+class NoteBulkDeletePayload(BaseModel):
+    ids: List[UUID] = Field(
+        title="The uuids of the notes to delete",
+        example=[uuid4(), uuid4()],
+        min_items=1,
+        max_items=settings.MAX_BULK_DELETE,
+    )
+
+
+class NoteBulkDeleteResult(BaseModel):
+    deleted: List[UUID] = Field(
+        title="The uuids of the notes that were deleted",
+        example=[uuid4()],
+    )
+    not_found: List[UUID] = Field(
+        title="The uuids that are not notes of the user",
+        example=[uuid4()],
+    )
+
+
 class SimplifiedNoteObject(BaseModel):
     id: UUID = Field(
         title="The UUID of the note",
@@ -67,6 +117,16 @@ class SimplifiedNoteObject(BaseModel):
     )
 
 
+class NotePage(BaseModel):
+    notes: List[SimplifiedNoteObject] = Field(
+        title="The notes in this page, newest first",
+    )
+    next_cursor: Optional[str] = Field(
+        title="Pass as cursor to get the next page, null on the last page",
+        example="MjAyMi0wOS0wMVQxMDowMDowMCswMDowMHw0ZjJk",
+    )
+
+
 class NoteObject(BaseModel):
     id: UUID = Field(
         title="The UUID of the note",
@@ -0,0 +1,33 @@
+"""
+ids.py
+Primary key generators for our tables
+"""
+# System imports
+import os
+import time
+from uuid import UUID, uuid4
+
+# Local imports
+from api.config import IdStrategy
+
+
+def uuid7() -> UUID:
+    """
+    Time ordered UUID (version 7), 48 bits of unix milliseconds followed by
+    random bits, so new keys always land at the right edge of the index
+    """
+    timestamp_ms = time.time_ns() // 1_000_000
+    value = (timestamp_ms << 80) | int.from_bytes(os.urandom(10), "big")
+
+    # version 7 and the RFC 4122 variant
+    value = (value & ~(0xF << 76)) | (0x7 << 76)
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)
+    return UUID(int=value)
+
+
+# Python side column default for each strategy, None leaves it to the server
+ID_GENERATORS = {
+    IdStrategy.SERVER: None,
+    IdStrategy.UUID4: uuid4,
+    IdStrategy.UUID7: uuid7,
+}
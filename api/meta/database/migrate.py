@@ -0,0 +1,124 @@
+"""
+migrate.py
+Versioned schema migrations for the pg database, run from the command line
+
+    python -m api.meta.database.migrate upgrade            # to the latest revision
+    python -m api.meta.database.migrate downgrade -1       # one revision back
+    python -m api.meta.database.migrate stamp 0001         # adopt an existing database
+    python -m api.meta.database.migrate current
+    python -m api.meta.database.migrate check              # report missing indexes
+"""
+# System imports
+import argparse
+import logging
+import os
+import sys
+
+# Package imports
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, text
+
+# Local imports
+from api.utils.database import get_database_url
+from api.meta.database.model import Base
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+
+def get_config() -> Config:
+    """Alembic configuration pointing at our migrations folder"""
+    config = Config()
+    config.set_main_option("script_location", MIGRATIONS_DIR)
+    # configparser treats % as interpolation, passwords may contain it
+    config.set_main_option("sqlalchemy.url", get_database_url().replace("%", "%%"))
+    return config
+
+
+def missing_indexes(engine) -> list:
+    """
+    Compare the indexes declared on the models with the ones in the database,
+    returns "table.index" for every index that is declared but not present.
+    """
+    # pg_indexes rather than the inspector, which skips expression indexes
+    with engine.connect() as connection:
+        existing = set(
+            connection.execute(
+                text(
+                    "SELECT tablename, indexname FROM pg_indexes "
+                    "WHERE schemaname = current_schema()"
+                )
+            ).all()
+        )
+
+    return sorted(
+        f"{table.name}.{index.name}"
+        for table in Base.metadata.sorted_tables
+        for index in table.indexes
+        if (table.name, index.name) not in existing
+    )
+
+
+def check() -> int:
+    """Print the missing indexes, the exit code is 1 if there are any"""
+    engine = create_engine(get_database_url())
+    try:
+        missing = missing_indexes(engine)
+    finally:
+        engine.dispose()
+
+    for name in missing:
+        print(f"missing index: {name}")
+
+    if missing:
+        print("run `python -m api.meta.database.migrate upgrade` to create them")
+        return 1
+
+    print("all model indexes are present")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the database schema")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    upgrade = subparsers.add_parser("upgrade", help="upgrade to a later revision")
+    upgrade.add_argument("revision", nargs="?", default="head")
+    upgrade.add_argument("--sql", action="store_true", help="print the SQL only")
+
+    downgrade = subparsers.add_parser("downgrade", help="revert to a previous revision")
+    downgrade.add_argument("revision", help="target revision, e.g. -1 or base")
+    downgrade.add_argument("--sql", action="store_true", help="print the SQL only")
+
+    stamp = subparsers.add_parser(
+        "stamp", help="mark the database as being at a revision without running it"
+    )
+    stamp.add_argument("revision")
+
+    subparsers.add_parser("current", help="show the current revision")
+    subparsers.add_parser("history", help="list every revision")
+    subparsers.add_parser("check", help="report indexes missing from the database")
+
+    args = parser.parse_args(argv)
+    config = get_config()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    if args.action == "upgrade":
+        command.upgrade(config, args.revision, sql=args.sql)
+    elif args.action == "downgrade":
+        command.downgrade(config, args.revision, sql=args.sql)
+    elif args.action == "stamp":
+        command.stamp(config, args.revision)
+    elif args.action == "current":
+        command.current(config)
+    elif args.action == "history":
+        command.history(config)
+    elif args.action == "check":
+        return check()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+"""
+env.py
+Alembic environment, invoked by api.meta.database.migrate
+"""
+# Package imports
+from alembic import context
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+# Local imports
+from api.utils.database import get_database_url
+from api.meta.database.model import Base
+
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():
+    """Emit the migration SQL to stdout without connecting"""
+    context.configure(
+        url=get_database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Run the migrations against the configured database"""
+    engine = create_engine(get_database_url(), poolclass=NullPool)
+
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,71 @@
+"""initial schema
+
+The user and note tables as they were before migrations were introduced.
+Databases that already have them should run `migrate stamp 0001` once
+instead of upgrading through this revision.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+# Package imports
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+newUUIDSql = (
+    "overlay(overlay(md5(random()::text || ':' || clock_timestamp()::text) "
+    "placing '4' from 13) placing '8' from 17)::uuid"
+)
+
+
+def upgrade():
+    op.create_table(
+        "user",
+        sa.Column(
+            "id",
+            postgresql.UUID(as_uuid=True),
+            server_default=sa.text(newUUIDSql),
+            nullable=False,
+        ),
+        sa.Column("created_date", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("updated_date", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("username", sa.String(length=64), nullable=False),
+        sa.Column("password", sa.String(length=256), nullable=False),
+        sa.Column("is_admin", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name="pk_user"),
+        sa.UniqueConstraint("id", name="uq_user_id"),
+    )
+    op.create_table(
+        "note",
+        sa.Column(
+            "id",
+            postgresql.UUID(as_uuid=True),
+            server_default=sa.text(newUUIDSql),
+            nullable=False,
+        ),
+        sa.Column("created_date", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("updated_date", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("title", sa.String(length=128), nullable=False),
+        sa.Column("description", sa.String(length=512), nullable=False),
+        sa.Column("user_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["user.id"],
+            name="fk_note_user_id_user",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name="pk_note"),
+        sa.UniqueConstraint("id", name="uq_note_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("note")
+    op.drop_table("user")
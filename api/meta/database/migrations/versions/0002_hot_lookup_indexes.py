@@ -0,0 +1,74 @@
+"""indexes for the hot user and note lookups
+
+- unique lower(username), used by signup and login
+- (user_id, created_date DESC) on note, used by fetch_notes
+
+Both are built CONCURRENTLY so writes keep flowing on a large note table.
+A failed concurrent build leaves an INVALID index behind, drop it before
+retrying.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+# Package imports
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the unique index can't be built over usernames that only differ by case
+    duplicates = []
+    if not op.get_context().as_sql:
+        duplicates = (
+            op.get_bind()
+            .execute(
+                sa.text(
+                    'SELECT lower(username) FROM "user" '
+                    "GROUP BY lower(username) HAVING count(*) > 1"
+                )
+            )
+            .scalars()
+            .all()
+        )
+    if duplicates:
+        raise RuntimeError(
+            "usernames must be unique ignoring case before upgrading, "
+            f"duplicated: {', '.join(duplicates)}"
+        )
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_user_username_lower",
+            "user",
+            [sa.text("lower(username)")],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_note_user_id_created_date",
+            "note",
+            ["user_id", sa.text("created_date DESC")],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_note_user_id_created_date",
+            table_name="note",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_user_username_lower",
+            table_name="user",
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,28 @@
+"""stored rendering of note descriptions
+
+Nullable columns without a default, adding them doesn't rewrite the table.
+Existing notes get their rendering on their first view with RENDER_ON_WRITE.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+# Package imports
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("note", sa.Column("rendered_description", sa.Text(), nullable=True))
+    op.add_column("note", sa.Column("rendered_version", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("note", "rendered_version")
+    op.drop_column("note", "rendered_description")
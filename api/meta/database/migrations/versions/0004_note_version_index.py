@@ -0,0 +1,40 @@
+"""index for the ETag of note lists
+
+- (user_id, updated_date) on note, max(updated_date) and count(*) of a user's
+  notes are answered by an index-only scan
+
+Built CONCURRENTLY like the indexes of 0002, drop an INVALID leftover of a
+failed build before retrying.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+# Package imports
+from alembic import op
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_note_user_id_updated_date",
+            "note",
+            ["user_id", "updated_date"],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_note_user_id_updated_date",
+            table_name="note",
+            postgresql_concurrently=True,
+        )
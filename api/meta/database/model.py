@@ -13,6 +13,10 @@ from sqlalchemy import (
     ForeignKeyConstraint,
     Column,
     Boolean,
+    Index,
+    Text,
+    event,
+    func,
     text,
 )
 
@@ -20,9 +24,17 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import TIMESTAMP, UUID
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import NEVER_SET, NO_VALUE
 from sqlalchemy_utils import generic_repr
 import pytz
 
+# Local imports
+from api.config import get_settings
+from api.meta.database.ids import ID_GENERATORS
+
+# -----------------------
+settings = get_settings()
+# -----------------------
 
 meta = MetaData(
     naming_convention={
@@ -39,6 +51,10 @@ newUUIDSql = (
     "placing '4' from 13) placing '8' from 17)::uuid"
 )
 
+# ids are generated in python unless ID_STRATEGY is "server", the server
+# default stays for rows inserted outside of the ORM
+newId = ID_GENERATORS[settings.ID_STRATEGY]
+
 
 def time_now():
     """Return current time in AEST"""
@@ -65,6 +81,7 @@ class User(Base):
     id = Column(
         UUID(as_uuid=True),
         primary_key=True,
+        default=newId,
         server_default=text(newUUIDSql),
         unique=True,
     )
@@ -92,6 +109,10 @@ class User(Base):
     )
 
 
+# signup and login look users up by lower(username), which must be unique
+Index("ix_user_username_lower", func.lower(User.username), unique=True)
+
+
 #############
 # NOTES TABLE
 #############
@@ -103,6 +124,7 @@ class Note(Base):
     id = Column(
         UUID(as_uuid=True),
         primary_key=True,
+        default=newId,
         server_default=text(newUUIDSql),
         unique=True,
     )
@@ -131,6 +153,17 @@ class Note(Base):
         nullable=False,
     )
 
+    # The description rendered by the RENDERER_VERSION in rendered_version,
+    # only stored when RENDER_ON_WRITE is enabled
+    rendered_description = Column(
+        Text,
+        nullable=True,
+    )
+    rendered_version = Column(
+        Integer,
+        nullable=True,
+    )
+
     # relationship to user
     user_id = Column(
         UUID(as_uuid=True),
@@ -145,3 +178,17 @@ class Note(Base):
         passive_deletes=True,
         cascade="delete,all",
     )
+
+
+@event.listens_for(Note.description, "set")
+def _drop_stale_rendering(note, value, oldvalue, initiator):
+    """A stored rendering no longer matches a changed description"""
+    if oldvalue not in (NO_VALUE, NEVER_SET) and value != oldvalue:
+        note.rendered_description = None
+        note.rendered_version = None
+
+
+# fetch_notes filters by owner and lists newest first
+Index("ix_note_user_id_created_date", Note.user_id, Note.created_date.desc())
+# the ETag of a note list only needs these two columns, read without the table
+Index("ix_note_user_id_updated_date", Note.user_id, Note.updated_date)
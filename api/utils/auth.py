@@ -5,12 +5,20 @@ from fastapi.security import (
     HTTPBearer,
     HTTPBasicCredentials,
 )
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from datetime import datetime, timedelta
+from hashlib import sha256
+from typing import NamedTuple
+from uuid import UUID
 
 # Local Imports
-from api.utils.database import get_db
+from api.utils import metrics
+from api.utils.cache import LRUCache
+from api.utils.database import get_db, get_async_db
+from api.utils.hashing import pwd_context
+from api.utils.statements import principal_by_id
 from api.meta.database.model import User
 from api.meta.constants.errors import SIGNATURE_EXPIRED, INVALID_TOKEN
 from api.config import get_settings
@@ -26,8 +34,10 @@ auth_header = HTTPBearer()
 
 class AuthHandler:
     security = HTTPBearer()
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    pwd_context = pwd_context
     secret = settings.SECRET
+    # verified payloads by token digest, shared by every handler of the process
+    verified_tokens = LRUCache(settings.VERIFIED_TOKEN_CACHE_SIZE)
 
     def get_password_hash(
         self,
@@ -67,6 +77,13 @@ class AuthHandler:
     ) -> str:
         "Decodes a JWT token"
 
+        # A token that verified before is valid until it expires,
+        # the cache entry expires with it
+        digest = sha256(token.encode()).digest()
+        payload = self.verified_tokens.get(digest)
+        if payload is not None:
+            return dict(payload)
+
         # Decode token
         try:
             payload = jwt.decode(
@@ -74,6 +91,11 @@ class AuthHandler:
                 key=self.secret,
                 algorithms=["HS256"],
             )
+            # without exp nothing bounds how long it stays cached, don't
+            if "exp" in payload:
+                self.verified_tokens.set(
+                    digest, dict(payload), expires_at=payload["exp"]
+                )
             return payload
 
         # Expired signature
@@ -96,30 +118,100 @@ class AuthHandler:
         return self.decode_token(auth.credentials)
 
 
+auth_handler = AuthHandler()
+metrics.register("verified_tokens", AuthHandler.verified_tokens.stats)
+
+
 def require_authentication(
     Authorization: HTTPBasicCredentials = Depends(auth_header),
 ):
-    auth_handler = AuthHandler()
     token = str(Authorization.credentials)
     decoded_token = auth_handler.decode_token(token)
 
     return decoded_token
 
 
+class Principal(NamedTuple):
+    """The authenticated user, detached from any session"""
+
+    id: UUID
+    username: str
+    is_admin: bool
+
+
+# Principals by user id, a change to a user reaches other workers within the ttl
+principals = LRUCache(settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL)
+metrics.register("principals", principals.stats)
+
+# Session.info key of the users changed or deleted by the session
+STALE_PRINCIPALS = "stale_principals"
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _mark_principal_stale(mapper, connection, target) -> None:
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(STALE_PRINCIPALS, set()).add(str(target.id))
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_stale_principals(session) -> None:
+    # only once committed, or a concurrent request could cache the old row again
+    for user_id in session.info.pop(STALE_PRINCIPALS, ()):
+        principals.pop(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _keep_principals(session) -> None:
+    session.info.pop(STALE_PRINCIPALS, None)
+
+
+def unknown_user(auth: dict) -> HTTPException:
+    return HTTPException(
+        status_code=403,
+        detail=USER_DOES_NOT_EXIST,
+        headers={"Authorization": auth},
+    )
+
+
 def require_user_account(
     auth: dict = Depends(require_authentication),
     db: Session = Depends(get_db),
-) -> User:
+) -> Principal:
     """Given an auth token, returns the user account information"""
 
+    principal = principals.get(auth["id"])
+    if principal is not None:
+        return principal
+
     # Get user_id from firebase auth UID
-    userInfo = db.query(User).filter(User.id == auth["id"]).first()
+    row = db.execute(principal_by_id(auth["id"])).first()
 
-    if userInfo is None:
-        raise HTTPException(
-            status_code=403,
-            detail=USER_DOES_NOT_EXIST,
-            headers={"Authorization": auth},
-        )
+    if row is None:
+        raise unknown_user(auth)
+
+    principal = Principal._make(row)
+    principals.set(auth["id"], principal)
+    return principal
+
+
+async def require_user_account_async(
+    auth: dict = Depends(require_authentication),
+    db: AsyncSession = Depends(get_async_db),
+) -> Principal:
+    """Async twin of require_user_account for the async routers"""
+
+    principal = principals.get(auth["id"])
+    if principal is not None:
+        return principal
+
+    result = await db.execute(principal_by_id(auth["id"]))
+    row = result.first()
+
+    if row is None:
+        raise unknown_user(auth)
 
-    return userInfo
+    principal = Principal._make(row)
+    principals.set(auth["id"], principal)
+    return principal
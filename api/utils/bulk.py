@@ -0,0 +1,86 @@
+"""
+bulk.py
+Writing many rows in one go, with multi-row INSERTs or COPY
+"""
+# System imports
+from io import StringIO
+
+# Package imports
+from sqlalchemy import Table, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+# Rows per INSERT statement, keeps the bind parameters well under postgres' 65535
+INSERT_CHUNK_SIZE = 1000
+
+
+def chunks(rows: list, size: int = INSERT_CHUNK_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start : start + size]
+
+
+def insert_rows(db: Session, table: Table, rows: list) -> list:
+    """
+    Insert dicts of column values with multi-row INSERT statements,
+    returns the primary keys in the same order as the rows
+    """
+    pk = table.primary_key.columns.values()[0]
+    ids = []
+    for chunk in chunks(rows):
+        ids += db.execute(insert(table).values(chunk).returning(pk)).scalars().all()
+    return ids
+
+
+async def insert_rows_async(db: AsyncSession, table: Table, rows: list) -> list:
+    """Async version of insert_rows"""
+    pk = table.primary_key.columns.values()[0]
+    ids = []
+    for chunk in chunks(rows):
+        result = await db.execute(insert(table).values(chunk).returning(pk))
+        ids += result.scalars().all()
+    return ids
+
+
+def csv_field(value) -> str:
+    """
+    A field of COPY's csv format. Only an unquoted empty field reads as
+    NULL, a quoted one is an empty string, so every value but None is quoted.
+    """
+    if value is None:
+        return ""
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(db: Session, table: Table, rows: list) -> None:
+    """
+    COPY dicts of column values into the table through the session connection,
+    so it's part of the session transaction. Every row must have the same keys
+    and carry its own primary key, COPY can't return generated values.
+    """
+    columns = list(rows[0].keys())
+    buffer = StringIO()
+    for row in rows:
+        buffer.write(",".join(csv_field(row[column]) for column in columns) + "\n")
+    buffer.seek(0)
+
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+async def copy_rows_async(db: AsyncSession, table: Table, rows: list) -> None:
+    """Async version of copy_rows, using asyncpg's binary COPY"""
+    columns = list(rows[0].keys())
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        table.name,
+        records=[tuple(row[column] for column in columns) for row in rows],
+        columns=columns,
+    )
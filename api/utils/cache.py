@@ -0,0 +1,110 @@
+"""
+cache.py
+Small in-process caches.
+Every gunicorn worker has its own copy, so anything cached here must be safe
+to serve stale for at most the entry's time to live.
+"""
+# System imports
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+from weakref import WeakSet
+
+_MISSING = object()
+_caches = WeakSet()
+
+
+def clear_caches() -> None:
+    """Empty every cache of the process, e.g. when the data behind them is reset"""
+    for cache in list(_caches):
+        cache.clear()
+
+
+class LRUCache:
+    """
+    Thread safe, size bounded LRU cache whose entries expire after ttl
+    seconds (never if ttl is None), or earlier at the expires_at timestamp
+    given to set()
+
+    maxsize bounds the number of entries, or with weigh the total weight of
+    their values, e.g. weigh=len to bound the bytes of cached bodies.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None, weigh: Callable = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        _caches.add(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at, _ = entry
+                if expires_at is None or expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at: float = None) -> None:
+        """Add or replace an entry, expires_at is a time.time() timestamp"""
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            ttl_expiry = time.time() + self.ttl
+            expires_at = (
+                ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+            )
+
+        weight = 1 if self.weigh is None else self.weigh(value)
+        with self._lock:
+            self._remove(key)
+            if weight > self.maxsize:
+                return
+            self._entries[key] = (value, expires_at, weight)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key) -> None:
+        """Drop the entry if there is one, the lock must be held"""
+        entry = self._entries.pop(key, _MISSING)
+        if entry is not _MISSING:
+            self.weight -= entry[2]
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            self._remove(key)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "weight": self.weight,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -1 +1,29 @@
-from fastapi import Cookie
+from fastapi import Cookie, Response
+import time
+
+# Set on write requests, keeps the client's reads on the primary while it's valid
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+def set_read_primary_cookie(
+    response: Response,
+    seconds: int,
+) -> None:
+    response.set_cookie(
+        READ_PRIMARY_COOKIE,
+        str(int(time.time()) + seconds),
+        max_age=seconds,
+        httponly=True,
+    )
+
+
+def reads_from_primary(
+    read_primary_until: str,
+) -> bool:
+    "Whether the cookie still asks for reads from the primary"
+    try:
+        return (
+            read_primary_until is not None and float(read_primary_until) > time.time()
+        )
+    except ValueError:
+        return False
@@ -2,50 +2,564 @@
 database.py
 Connection to the pg database
 """
+# System imports
+import asyncio
+import os
+import time
+from collections import Counter
+from itertools import count
+from threading import Lock
+
 # Package imports
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from fastapi import Cookie, Request, Response
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, raiseload, sessionmaker
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.lambdas import StatementLambdaElement
+from sqlalchemy.util import await_only
 
 # Local imports
 from api.config import get_settings
+from api.utils import metrics
+from api.utils.pool import TimedAsyncAdaptedQueuePool, TimedQueuePool, watch_pool
+from api.utils.cookie_util import (
+    READ_PRIMARY_COOKIE,
+    reads_from_primary,
+    set_read_primary_cookie,
+)
 
 
 # -------------------------
 settings = get_settings()
 # ------------------------
 
+# Process-wide registry of engines and their sessionmakers, keyed by name.
+# Engines are created lazily on first use so that every gunicorn worker
+# builds its own pool after the fork.
+_engines = {}
+_sessionmakers = {}
+_async_engines = {}
+_async_sessionmakers = {}
+_registry_lock = Lock()
 
-def get_db():
-    """
-    Get the db session
-    """
-    SQLALCHEMY_DATABASE_URL = "postgresql+psycopg2://%s:%s@%s/%s" % (
+PRIMARY = "primary"
+REPLICA = "replica"
+
+# Requests with these methods may read from a replica, everything else writes
+READ_METHODS = {"GET", "HEAD"}
+
+# Round-robin position and health of the replicas
+_replica_counter = count()
+_replica_down_until = {}
+
+# Session.info flag for sessions where relationships must be loaded explicitly
+RAISE_ON_LAZY_LOAD = "raise_on_lazy_load"
+
+# Compiled statement cache lookups of every engine, see watch_statement_cache
+_statement_cache = Counter()
+
+
+def get_database_url(
+    host: str = None,
+    driver: str = "psycopg2",
+) -> str:
+    """Build the connection url for the given host (defaults to the primary)"""
+    return "postgresql+%s://%s:%s@%s/%s" % (
+        driver,
         settings.DATABASE_USER,
         settings.DATABASE_PASSWORD,
-        settings.DATABASE_HOST,
+        host or settings.DATABASE_HOST,
         settings.DATABASE_NAME,
     )
 
-    db_config = {
+
+def replica_names() -> list:
+    """Registry names of the configured replicas"""
+    return [
+        f"{REPLICA}-{index}" for index in range(len(settings.DATABASE_REPLICA_HOSTS))
+    ]
+
+
+def get_host(name: str) -> str:
+    """Host of the named engine"""
+    if name == PRIMARY:
+        return settings.DATABASE_HOST
+    return settings.DATABASE_REPLICA_HOSTS[replica_names().index(name)]
+
+
+def get_pool_config() -> dict:
+    """Pool parameters shared by every engine, sourced from the settings"""
+    return {
         # Maximum number of permanent connections to keep.
-        "pool_size": 5,
+        "pool_size": settings.DATABASE_POOL_SIZE,
         # Temporarily exceeds the set pool size if no connections are available
-        "max_overflow": 2,
-        "pool_timeout": 30,  # 30 seconds
+        "max_overflow": settings.DATABASE_MAX_OVERFLOW,
+        "pool_timeout": settings.DATABASE_POOL_TIMEOUT,
         # maximum number of seconds a connection can persist
-        "pool_recycle": 1800,  # 30 minutes
+        "pool_recycle": settings.DATABASE_POOL_RECYCLE,
     }
 
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL,
-        connect_args={"connect_timeout": 15},
-        echo=False,
-        **db_config,
-    )
 
-    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = session_local()
+def get_engine(name: str = PRIMARY):
+    """
+    Get the engine registered under the given name, creating it on first use
+    """
+    engine = _engines.get(name)
+    if engine is not None:
+        return engine
+
+    with _registry_lock:
+        # another thread may have won the race while we waited
+        engine = _engines.get(name)
+        if engine is None:
+            engine = create_engine(
+                get_database_url(get_host(name)),
+                connect_args={"connect_timeout": settings.DATABASE_CONNECT_TIMEOUT},
+                echo=False,
+                # a dead replica should be noticed at checkout, not mid-query,
+                # ReplicaLink only checks one out for requests that read
+                pool_pre_ping=name != PRIMARY,
+                poolclass=TimedQueuePool,
+                query_cache_size=settings.DATABASE_STATEMENT_CACHE_SIZE,
+                **get_pool_config(),
+            )
+            watch_pool(name, engine)
+            watch_statement_cache(engine)
+            if name != PRIMARY:
+                watch_replica_health(name, engine)
+            _engines[name] = engine
+            _sessionmakers[name] = sessionmaker(
+                autocommit=False,
+                autoflush=False,
+                bind=engine,
+                class_=RoutingSession,
+                info={RAISE_ON_LAZY_LOAD: settings.RAISE_ON_LAZY_LOAD},
+            )
+
+    return engine
+
+
+def get_sessionmaker(name: str = PRIMARY) -> sessionmaker:
+    """Get the sessionmaker bound to the named engine"""
+    get_engine(name)
+    return _sessionmakers[name]
+
+
+def get_async_engine(name: str = PRIMARY):
+    """
+    Get the asyncpg engine registered under the given name, creating it on
+    first use. Only used when DATABASE_ASYNC is enabled.
+    """
+    engine = _async_engines.get(name)
+    if engine is not None:
+        return engine
+
+    with _registry_lock:
+        engine = _async_engines.get(name)
+        if engine is None:
+            engine = create_async_engine(
+                get_database_url(get_host(name), driver="asyncpg"),
+                connect_args={"timeout": settings.DATABASE_CONNECT_TIMEOUT},
+                echo=False,
+                pool_pre_ping=name != PRIMARY,
+                poolclass=TimedAsyncAdaptedQueuePool,
+                query_cache_size=settings.DATABASE_STATEMENT_CACHE_SIZE,
+                **get_pool_config(),
+            )
+            watch_pool(f"{name}_async", engine.sync_engine)
+            watch_statement_cache(engine.sync_engine)
+            if name != PRIMARY:
+                watch_replica_health(name, engine.sync_engine)
+            _async_engines[name] = engine
+            _async_sessionmakers[name] = sessionmaker(
+                autocommit=False,
+                autoflush=False,
+                # objects are read after commit, which can't lazy load in async
+                expire_on_commit=False,
+                bind=engine,
+                class_=AsyncSession,
+                sync_session_class=RoutingSession,
+                info={RAISE_ON_LAZY_LOAD: settings.RAISE_ON_LAZY_LOAD},
+            )
+
+    return engine
+
+
+def get_async_sessionmaker(name: str = PRIMARY) -> sessionmaker:
+    """Get the AsyncSession factory bound to the named async engine"""
+    get_async_engine(name)
+    return _async_sessionmakers[name]
+
+
+# --------------------------------------------------------------------------------
+# Read replicas
+# --------------------------------------------------------------------------------
+
+
+class ReplicaLink:
+    """
+    The replica a session reads from, connected by its first read, so a
+    request answered without a query never checks out a replica connection.
+    connect() returns a Connection or AsyncConnection, None when no replica
+    can be reached and reads go to the primary.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.connection = None
+        self.active = True
+        self._unreachable = False
+
+    def bind(self):
+        """The connection to read from, None to read from the primary"""
+        if self.connection is None and not self._unreachable:
+            self.connection = self._connect()
+            self._unreachable = self.connection is None
+        # an AsyncConnection, sessions bind to the connection it wraps
+        return getattr(self.connection, "sync_connection", self.connection)
+
+    def close(self) -> None:
+        """Give the connection back to its pool, the next read takes another"""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
+    async def close_async(self) -> None:
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            await connection.close()
+
+
+class RoutingSession(Session):
+    """
+    Session that sends its reads to the ReplicaLink in info[REPLICA].
+
+    As soon as the session writes (flush, INSERT/UPDATE/DELETE or any raw
+    statement) it sticks to the primary for the rest of its life, so a
+    request always reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get(REPLICA)
+        if replica is not None and replica.active:
+            # lambda statements wrap the Select they build
+            statement = getattr(clause, "_resolved", clause)
+            if not self._flushing and isinstance(statement, Select):
+                connection = replica.bind()
+                if connection is not None:
+                    return connection
+            else:
+                replica.active = False
+
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+def reads_from_replica(db: Session) -> bool:
+    """Whether the session has read from a replica, which may lag behind"""
+    replica = db.info.get(REPLICA)
+    return replica is not None and replica.connection is not None
+
+
+def mark_replica_down(name: str) -> None:
+    """Stop routing reads to the replica for DATABASE_REPLICA_RETRY seconds"""
+    _replica_down_until[name] = time.monotonic() + settings.DATABASE_REPLICA_RETRY
+
+
+def watch_replica_health(name: str, engine) -> None:
+    """Mark the replica down whenever connecting or talking to it fails"""
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(context):
+        dbapi = engine.dialect.dbapi
+        if context.is_disconnect or (
+            dbapi is not None
+            and isinstance(context.original_exception, dbapi.OperationalError)
+        ):
+            mark_replica_down(name)
+
+
+def choose_replica():
+    """Next healthy replica in round-robin order, None if there are none"""
+    names = replica_names()
+    now = time.monotonic()
+    for _ in names:
+        name = names[next(_replica_counter) % len(names)]
+        if _replica_down_until.get(name, 0) <= now:
+            return name
+    return None
+
+
+def may_read_from_replica(
+    request: Request,
+    response: Response,
+    read_primary_until: str,
+) -> bool:
+    """
+    Whether the request may read from a replica.
+
+    Write requests get a cookie that keeps the client's reads on the primary
+    for DATABASE_REPLICA_STICKY seconds, longer than the replication lag.
+    """
+    if not settings.DATABASE_REPLICA_HOSTS:
+        return False
+
+    if request.method not in READ_METHODS:
+        set_read_primary_cookie(response, settings.DATABASE_REPLICA_STICKY)
+        return False
+
+    return not reads_from_primary(read_primary_until)
+
+
+def connect_to_replica():
+    """
+    Connection to the next healthy replica, None when all of them are down.
+    Replica connections are pinged at checkout, one the replica dropped is
+    replaced, and a replica that can't be reached is marked down and the next
+    one is tried, so the request falls back to the primary instead of failing.
+    """
+    for _ in replica_names():
+        name = choose_replica()
+        if name is None:
+            return None
+        try:
+            return get_engine(name).connect()
+        except DBAPIError:
+            mark_replica_down(name)
+    return None
+
+
+def connect_to_replica_in_greenlet():
+    """
+    connect_to_replica_async for RoutingSession.get_bind, which runs in the
+    greenlet of an AsyncSession call
+    """
+    return await_only(connect_to_replica_async())
+
+
+async def connect_to_replica_async():
+    """Async version of connect_to_replica"""
+    for _ in replica_names():
+        name = choose_replica()
+        if name is None:
+            return None
+        try:
+            return await get_async_engine(name).connect()
+        # asyncpg raises plain socket and timeout errors when it can't connect
+        except (DBAPIError, OSError, asyncio.TimeoutError):
+            mark_replica_down(name)
+    return None
+
+
+# --------------------------------------------------------------------------------
+
+
+def dispose_engines(close: bool = True) -> None:
+    """
+    Dispose every registered engine and empty the registry.
+
+    With close=False the pooled connections are dropped without being closed,
+    which is what a forked child must do so it never touches the sockets it
+    inherited from its parent.
+    """
+    with _registry_lock:
+        for engine in _engines.values():
+            engine.dispose(close=close)
+        _engines.clear()
+        _sessionmakers.clear()
+        _drop_async_engines()
+
+
+async def dispose_async_engines() -> None:
+    """Close the pooled connections of every async engine"""
+    for engine in list(_async_engines.values()):
+        await engine.dispose()
+    _async_engines.clear()
+    _async_sessionmakers.clear()
+
+
+def _drop_async_engines() -> None:
+    """Forget the async engines without awaiting on their connections"""
+    for engine in _async_engines.values():
+        engine.sync_engine.dispose(close=False)
+    _async_engines.clear()
+    _async_sessionmakers.clear()
+
+
+def _registered_engines() -> list:
+    """(name, sync engine) of every registered engine, async ones included"""
+    engines = list(_engines.items())
+    engines += [
+        (f"{name}_async", engine.sync_engine)
+        for name, engine in list(_async_engines.items())
+    ]
+    return engines
+
+
+def pool_stats() -> dict:
+    """Current pool usage for every registered engine"""
+    stats = {}
+    for name, engine in _registered_engines():
+        pool = engine.pool
+        stats[name] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            # overflow counts up from -size, it's only in use above 0
+            "overflow_in_use": max(pool.overflow(), 0),
+            "status": pool.status(),
+        }
+        telemetry = getattr(pool, "telemetry", None)
+        if telemetry is not None:
+            stats[name].update(telemetry.snapshot())
+    return stats
+
+
+def _count_statement_cache(conn, cursor, statement, parameters, context, many):
+    if context is None:
+        return
+    if context.cache_hit is CACHE_HIT:
+        _statement_cache["hits"] += 1
+    elif context.cache_hit is CACHE_MISS:
+        _statement_cache["misses"] += 1
+    else:
+        # raw SQL strings, DDL and statements that opted out of caching
+        _statement_cache["uncached"] += 1
+
+
+def watch_statement_cache(engine) -> None:
+    """Count the compiled statement cache hits and misses of the engine"""
+    if not event.contains(engine, "before_cursor_execute", _count_statement_cache):
+        event.listen(engine, "before_cursor_execute", _count_statement_cache)
+
+
+def statement_cache_stats() -> dict:
+    """Compiled statement cache lookups since startup, and each engine cache size"""
+    hits, misses = _statement_cache["hits"], _statement_cache["misses"]
+    return {
+        "hits": hits,
+        "misses": misses,
+        "uncached": _statement_cache["uncached"],
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+        "size": {
+            name: len(engine._compiled_cache)
+            for name, engine in _registered_engines()
+            if engine._compiled_cache is not None
+        },
+    }
+
+
+metrics.register("pools", pool_stats)
+metrics.register("statement_cache", statement_cache_stats)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _raise_on_lazy_load(orm_execute_state) -> None:
+    """
+    Queries of a flagged session get raiseload("*"), so a relationship the
+    query didn't load with joinedload/selectinload raises when accessed
+    instead of silently firing another SELECT.
+    """
+    if (
+        orm_execute_state.session.info.get(RAISE_ON_LAZY_LOAD)
+        and orm_execute_state.is_select
+        and not orm_execute_state.is_column_load
+        and not orm_execute_state.is_relationship_load
+    ):
+        statement = orm_execute_state.statement
+        if isinstance(statement, StatementLambdaElement):
+            # extend the lambda rather than resolving it, so it stays cached
+            orm_execute_state.statement = statement + (
+                lambda s: s.options(raiseload("*", sql_only=True))
+            )
+        else:
+            orm_execute_state.statement = statement.options(
+                raiseload("*", sql_only=True)
+            )
+
+
+def _reset_after_fork() -> None:
+    """
+    A gunicorn worker forked from a parent that already opened connections
+    (e.g. with --preload) must not reuse the parent's sockets.
+    """
+    global _registry_lock
+
+    # the lock may have been held by another thread of the parent at fork time
+    _registry_lock = Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+    _sessionmakers.clear()
+    _drop_async_engines()
+    _statement_cache.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_db(
+    request: Request,
+    response: Response,
+    read_primary_until: str = Cookie(None, alias=READ_PRIMARY_COOKIE),
+):
+    """
+    Get the db session, reads of GET requests go to a replica when configured
+    """
+    db = get_sessionmaker()()
+    replica = None
+    if may_read_from_replica(request, response, read_primary_until):
+        replica = db.info[REPLICA] = ReplicaLink(connect_to_replica)
     try:
         yield db
     finally:
         db.close()
+        if replica is not None:
+            replica.close()
+
+
+async def get_async_db(
+    request: Request,
+    response: Response,
+    read_primary_until: str = Cookie(None, alias=READ_PRIMARY_COOKIE),
+):
+    """
+    Get an async db session, used by the async routers
+    """
+    replica = None
+    if may_read_from_replica(request, response, read_primary_until):
+        replica = ReplicaLink(connect_to_replica_in_greenlet)
+
+    try:
+        async with get_async_sessionmaker()() as db:
+            if replica is not None:
+                db.sync_session.info[REPLICA] = replica
+            yield db
+    finally:
+        if replica is not None:
+            await replica.close_async()
+
+
+def release_connections(db: Session) -> None:
+    """
+    End the transaction of the session and give its connections back to
+    their pools, before work that keeps the request busy without the
+    database. Loaded objects are expired, and the session checks out a
+    connection again if it is used afterwards.
+    """
+    db.commit()
+    replica = db.info.get(REPLICA)
+    if replica is not None:
+        replica.close()
+
+
+async def release_connections_async(db: AsyncSession) -> None:
+    """Async version of release_connections"""
+    await db.commit()
+    replica = db.sync_session.info.get(REPLICA)
+    if replica is not None:
+        await replica.close_async()
@@ -0,0 +1,156 @@
+"""
+hashing.py
+bcrypt hashing in a pool of worker processes.
+A password hash costs hundreds of milliseconds of CPU, run in the request
+threads a burst of logins starves every other route of the worker. Here it
+runs in a WorkerPool, and once HASHING_QUEUE_SIZE requests are waiting new
+ones are turned away with a 429 instead of queueing without bound.
+
+The cost is set by BCRYPT_ROUNDS, pick it for this hardware with
+
+    python -m api.utils.hashing --target-ms 250
+"""
+# System imports
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# Package imports
+from passlib.context import CryptContext
+
+# Local imports
+from api.config import get_settings
+from api.utils import metrics
+from api.utils.workers import WorkerPool
+from api.meta.constants.errors import (
+    PASSWORD_HASHING_BUSY,
+    PASSWORD_HASHING_UNAVAILABLE,
+)
+
+# -----------------------
+settings = get_settings()
+# -----------------------
+
+# Hashes made with any other number of rounds need an update, login redoes them
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether the hash was made with other settings, cheap, it only parses the hash"""
+    return pwd_context.needs_update(hashed_password)
+
+
+class PasswordHasher(WorkerPool):
+    """Runs hash_password and verify_password in a WorkerPool"""
+
+    name = "hashing"
+    busy_detail = PASSWORD_HASHING_BUSY
+    unavailable_detail = PASSWORD_HASHING_UNAVAILABLE
+
+    def hash(self, password: str) -> str:
+        """Hash the password, blocking the calling thread until it's done"""
+        return self._result(self._submit(hash_password, password))
+
+    def verify(self, password: str, hashed_password: str) -> bool:
+        return self._result(self._submit(verify_password, password, hashed_password))
+
+    async def hash_async(self, password: str) -> str:
+        """Hash the password without blocking the event loop"""
+        return await self._result_async(self._submit(hash_password, password))
+
+    async def verify_async(self, password: str, hashed_password: str) -> bool:
+        return await self._result_async(
+            self._submit(verify_password, password, hashed_password)
+        )
+
+
+password_hasher = PasswordHasher(
+    settings.HASHING_PROCESSES, settings.HASHING_QUEUE_SIZE
+)
+metrics.register("password_hashing", password_hasher.stats)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=password_hasher.forget)
+
+
+# --------------------------------------------------------------------------------
+# Calibration
+# --------------------------------------------------------------------------------
+
+# bcrypt accepts 4 to 31, below 10 is too cheap to brute force
+MIN_ROUNDS = 10
+MAX_ROUNDS = 31
+
+
+def time_rounds(rounds: int, samples: int = 5) -> float:
+    """Median seconds to hash a password with the given rounds on this host"""
+    context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        context.hash("calibration password")
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def recommend_rounds(target: float, base_rounds: int = MIN_ROUNDS) -> tuple:
+    """
+    The most rounds whose hash takes at most target seconds, and its
+    estimated time. Each round doubles the work, so one measurement is
+    enough to extrapolate the others.
+    """
+    base = time_rounds(base_rounds)
+    rounds = base_rounds
+    while rounds < MAX_ROUNDS and base * 2 ** (rounds + 1 - base_rounds) <= target:
+        rounds += 1
+    return rounds, base * 2 ** (rounds - base_rounds)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Recommend BCRYPT_ROUNDS for a target hash latency on this host"
+    )
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=250,
+        help="longest a single hash may take, in milliseconds",
+    )
+    args = parser.parse_args(argv)
+
+    rounds, estimate = recommend_rounds(args.target_ms / 1000)
+    measured = time_rounds(rounds)
+    current = time_rounds(settings.BCRYPT_ROUNDS)
+
+    print(f"current  BCRYPT_ROUNDS={settings.BCRYPT_ROUNDS}: {current * 1000:.0f}ms")
+    print(
+        f"suggested BCRYPT_ROUNDS={rounds}: {measured * 1000:.0f}ms "
+        f"(estimated {estimate * 1000:.0f}ms, target {args.target_ms:.0f}ms)"
+    )
+    if estimate > args.target_ms / 1000:
+        print(f"even {MIN_ROUNDS} rounds exceed the target on this host")
+    print(
+        "each extra round doubles the hash time, so the same login rate "
+        "needs twice the HASHING_PROCESSES"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+metrics.py
+In-process metrics of the worker.
+Subsystems register a function returning their current numbers, snapshot()
+collects all of them. Everything is per process, every gunicorn worker
+reports its own.
+"""
+# System imports
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable
+
+_sources = {}
+
+
+def register(name: str, collect: Callable[[], dict]) -> None:
+    """Add a source to the snapshot, replacing any source of the same name"""
+    _sources[name] = collect
+
+
+def snapshot() -> dict:
+    """Current numbers of every registered source"""
+    return {name: collect() for name, collect in list(_sources.items())}
+
+
+class Histogram:
+    """
+    Fixed buckets histogram, bucket i counts the observations
+    <= bounds[i] and the last one everything above the largest bound
+    """
+
+    def __init__(self, bounds: tuple):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            buckets = {
+                str(bound): count for bound, count in zip(self.bounds, self.counts)
+            }
+            buckets["+Inf"] = self.counts[-1]
+            return {
+                "buckets": buckets,
+                "count": self.count,
+                "sum": self.sum,
+                "max": self.max,
+            }
@@ -0,0 +1,61 @@
+"""
+pagination.py
+Opaque keyset cursors for the list endpoints
+"""
+# System imports
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from uuid import UUID
+
+# Package imports
+from fastapi import HTTPException, status
+from sqlalchemy import and_, tuple_
+
+# Local imports
+from api.config import get_settings
+from api.meta.constants.errors import INVALID_CURSOR
+
+# -----------------------
+settings = get_settings()
+# -----------------------
+
+
+def page_size(limit: int = None) -> int:
+    """The requested page size, capped by the server side maximum"""
+    if limit is None:
+        return settings.PAGE_SIZE
+    return min(limit, settings.MAX_PAGE_SIZE)
+
+
+def encode_cursor(created_date: datetime, id: UUID) -> str:
+    """Encode the position of the last row of a page"""
+    raw = f"{created_date.isoformat()}|{id}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor made by encode_cursor into (created_date, id)"""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        created_date, id = urlsafe_b64decode(cursor + padding).decode().split("|")
+        return datetime.fromisoformat(created_date), UUID(id)
+
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=INVALID_CURSOR,
+        )
+
+
+def keyset_after(created_column, id_column, created_date: datetime, id: UUID):
+    """
+    Filter for the rows after a decoded cursor, in (created_date, id) DESC order.
+
+    The lone created_date bound is redundant but lets postgres seek straight
+    to the cursor in a (..., created_date DESC) index, so every page costs
+    the same as the first one.
+    """
+    return and_(
+        created_column <= created_date,
+        tuple_(created_column, id_column) < tuple_(created_date, id),
+    )
@@ -0,0 +1,150 @@
+"""
+pool.py
+Telemetry of the connection pools.
+How long requests wait for a connection, how old the connections they get
+are, and how often connections are opened, recycled and invalidated.
+"""
+# System imports
+import logging
+import time
+from threading import Lock
+from weakref import WeakSet
+
+# Package imports
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Local imports
+from api.config import get_settings
+from api.utils.metrics import Histogram
+
+# -----------------------
+settings = get_settings()
+# -----------------------
+
+logger = logging.getLogger(__name__)
+
+# seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+AGE_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600)
+
+# at most one saturation warning per pool in this many seconds
+WARNING_INTERVAL = 10
+
+
+class PoolTelemetry:
+    """Counters and histograms of one engine's pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wait = Histogram(WAIT_BUCKETS)
+        self.age = Histogram(AGE_BUCKETS)
+        self.connects = 0
+        self.recycles = 0
+        self.invalidations = 0
+        self.slow_checkouts = 0
+        self.peak_checked_out = 0
+        self._records = WeakSet()
+        self._unreported = 0
+        self._warned_at = 0.0
+        self._lock = Lock()
+
+    def observe_wait(self, pool: QueuePool, seconds: float) -> None:
+        """Record how long a checkout waited, warn when the pool is saturated"""
+        self.wait.observe(seconds)
+        checked_out = pool.checkedout()
+        with self._lock:
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            if seconds < settings.DATABASE_POOL_WAIT_WARNING:
+                return
+            self.slow_checkouts += 1
+            self._unreported += 1
+            now = time.monotonic()
+            if now - self._warned_at < WARNING_INTERVAL:
+                return
+            self._warned_at, slow, self._unreported = now, self._unreported, 0
+
+        logger.warning(
+            "%s pool saturated: waited %.2fs for a connection "
+            "(%d slow checkouts since the last warning), "
+            "%d checked out, %d overflow in use",
+            self.name,
+            seconds,
+            slow,
+            checked_out,
+            max(pool.overflow(), 0),
+        )
+
+    def observe_connect(self, record) -> None:
+        """A record opening a connection it already had before is a recycle"""
+        with self._lock:
+            self.connects += 1
+            if record in self._records:
+                self.recycles += 1
+            else:
+                self._records.add(record)
+
+    def snapshot(self) -> dict:
+        return {
+            "wait_seconds": self.wait.snapshot(),
+            "age_seconds": self.age.snapshot(),
+            "connects": self.connects,
+            "recycles": self.recycles,
+            "invalidations": self.invalidations,
+            "slow_checkouts": self.slow_checkouts,
+            "peak_checked_out": self.peak_checked_out,
+        }
+
+
+class _TimedCheckout:
+    """
+    Times how long getting a connection out of the pool takes.
+    Pool events only fire once a connection was handed out, so the wait
+    itself is measured around _do_get.
+    """
+
+    telemetry = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        record = super()._do_get()
+        if self.telemetry is not None:
+            self.telemetry.observe_wait(self, time.perf_counter() - started)
+        return record
+
+    def recreate(self):
+        # engine.dispose() swaps the pool for a recreated one
+        pool = super().recreate()
+        pool.telemetry = self.telemetry
+        return pool
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def watch_pool(name: str, engine) -> PoolTelemetry:
+    """
+    Collect the telemetry of an engine created with one of the timed pools,
+    returns the telemetry, also reachable as engine.pool.telemetry
+    """
+    telemetry = PoolTelemetry(name)
+    engine.pool.telemetry = telemetry
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        telemetry.observe_connect(connection_record)
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        telemetry.age.observe(time.time() - connection_record.starttime)
+
+    @event.listens_for(engine, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        telemetry.invalidations += 1
+
+    return telemetry
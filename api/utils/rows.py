@@ -0,0 +1,57 @@
+"""
+rows.py
+Lightweight read layer for list style endpoints.
+Selects only the columns a response needs with Core and returns them as
+named tuples, without hydrating ORM objects or touching the identity map.
+"""
+# System imports
+from datetime import datetime
+from typing import NamedTuple
+from uuid import UUID
+
+# Package imports
+from sqlalchemy import Table, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+
+# ----------------------
+# Row types
+# ----------------------
+# Field names must match the column names of the table they are read from.
+
+
+class NoteListRow(NamedTuple):
+    id: UUID
+    title: str
+    created_date: datetime
+
+
+class NoteExportRow(NamedTuple):
+    id: UUID
+    title: str
+    description: str
+    created_date: datetime
+    updated_date: datetime
+
+
+# ----------------------
+# Queries
+# ----------------------
+
+
+def select_rows(row_type: type, table: Table) -> Select:
+    """Core select of the table columns named by the row type fields"""
+    return select(*[table.c[field] for field in row_type._fields])
+
+
+def fetch_rows(db: Session, statement: Select, row_type: type) -> list:
+    """Run a select_rows statement and build one row_type per result row"""
+    return list(map(row_type._make, db.execute(statement)))
+
+
+async def fetch_rows_async(db: AsyncSession, statement: Select, row_type: type) -> list:
+    """Async version of fetch_rows"""
+    result = await db.execute(statement)
+    return list(map(row_type._make, result))
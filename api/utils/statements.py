@@ -0,0 +1,134 @@
+"""
+statements.py
+The hot queries, built as lambda statements.
+SQLAlchemy builds each one once, then caches it with its compiled SQL keyed by
+the lambda's code, so a request only pays for pulling the bound values out of
+the closure instead of building and hashing a fresh statement tree.
+
+Closure variables are always bound parameters, typed after their first value
+rather than the column they're compared to, so ids go through type_coerce to get
+the column's bind processing whether they arrive as str or UUID. Values that
+change the shape of the query (a cursor being present) pick between lambdas
+outside of them, and anything computed from a value (limit + 1) is computed
+before the lambda.
+"""
+# System imports
+from datetime import datetime
+from uuid import UUID
+
+# Package imports
+from sqlalchemy import func, lambda_stmt, select, type_coerce, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload, raiseload
+from sqlalchemy.sql.lambdas import StatementLambdaElement
+
+# Local imports
+from api.meta.database.model import Note, User
+from api.utils.pagination import keyset_after
+from api.utils.rows import NoteListRow, select_rows
+
+
+def principal_by_id(user_id: UUID) -> StatementLambdaElement:
+    """The id, username and is_admin of the user, as a plain row"""
+    return lambda_stmt(
+        lambda: select(User.id, User.username, User.is_admin).where(
+            User.id == type_coerce(user_id, User.id.type)
+        )
+    )
+
+
+def user_by_username(username: str) -> StatementLambdaElement:
+    """The user with that username ignoring case, without its notes"""
+    username = username.lower()
+    return lambda_stmt(
+        lambda: select(User)
+        .options(raiseload(User.notes))
+        .where(func.lower(User.username) == username)
+    )
+
+
+def insert_user(username: str, password: str, is_admin: bool) -> StatementLambdaElement:
+    """
+    Create the user unless the username is taken ignoring case, returns the
+    new id or no row. The unique lower(username) index settles concurrent
+    signups, so there's no window between a check and the insert.
+    """
+    return lambda_stmt(
+        lambda: insert(User.__table__)
+        .values(username=username, password=password, is_admin=is_admin)
+        .on_conflict_do_nothing(index_elements=[func.lower(User.username)])
+        .returning(User.id)
+    )
+
+
+def update_password(
+    user_id: UUID, old_hash: str, new_hash: str
+) -> StatementLambdaElement:
+    """Replace the password hash, unless it changed since old_hash was read"""
+    return lambda_stmt(
+        lambda: update(User.__table__)
+        .where(
+            User.id == type_coerce(user_id, User.id.type),
+            User.password == old_hash,
+        )
+        .values(password=new_hash)
+    )
+
+
+def note_with_owner(note_id: UUID) -> StatementLambdaElement:
+    """The note, with its owner loaded in the same round trip"""
+    return lambda_stmt(
+        lambda: select(Note)
+        .options(joinedload(Note.user))
+        .where(Note.id == type_coerce(note_id, Note.id.type))
+    )
+
+
+def notes_page(
+    user_id: UUID,
+    after: tuple[datetime, UUID],
+    limit: int,
+) -> StatementLambdaElement:
+    """
+    One page of the user notes after the decoded cursor (None for the first
+    page), plus one row to know if there's more
+    """
+    note = Note.__table__
+    stmt = lambda_stmt(
+        lambda: select_rows(NoteListRow, note).where(
+            note.c.user_id == type_coerce(user_id, note.c.user_id.type)
+        )
+    )
+    if after is not None:
+        created_date, id = after
+        stmt += lambda s: s.where(
+            keyset_after(note.c.created_date, note.c.id, created_date, id)
+        )
+
+    fetch = limit + 1
+    stmt += lambda s: s.order_by(note.c.created_date.desc(), note.c.id.desc()).limit(
+        fetch
+    )
+    return stmt
+
+
+def note_version(note_id: UUID) -> StatementLambdaElement:
+    """The updated_date of the note and whether its owner is an admin"""
+    return lambda_stmt(
+        lambda: select(Note.updated_date, User.is_admin)
+        .join(User, Note.user_id == User.id)
+        .where(Note.id == type_coerce(note_id, Note.id.type))
+    )
+
+
+def notes_version(user_id: UUID) -> StatementLambdaElement:
+    """
+    The latest updated_date and the number of the user notes, both read
+    from the (user_id, updated_date) index alone
+    """
+    note = Note.__table__
+    return lambda_stmt(
+        lambda: select(func.max(note.c.updated_date), func.count()).where(
+            note.c.user_id == type_coerce(user_id, note.c.user_id.type)
+        )
+    )
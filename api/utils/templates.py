@@ -0,0 +1,426 @@
+"""
+templates.py
+Rendering of note descriptions as Jinja templates.
+Compiling a template is far more expensive than rendering it, so the
+compiled templates are kept in an LRU keyed by a hash of their source, and
+a popular note is compiled once per render process instead of once per view.
+
+Descriptions are rendered by note_renderer, a WorkerPool, so a note looping
+for seconds only holds a render process. Each render gets RENDER_CPU_SECONDS
+of CPU and RENDER_MAX_OUTPUT characters, and the view gives up on it after
+RENDER_TIMEOUT.
+
+With RENDER_ON_WRITE the rendering is also stored with the note, stamped
+with RENDERER_VERSION, and views serve it without any template work.
+
+The HTML pages come from JINJA_FILE_PATH through page_env, whose compiled
+templates are kept on disk so a booting worker loads them instead of
+compiling them again.
+"""
+# System imports
+import asyncio
+import math
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+from concurrent.futures.process import BrokenProcessPool
+from asyncio import TimeoutError as AsyncTimeoutError
+from itertools import count
+from threading import Lock
+from hashlib import sha256
+from typing import Optional
+
+# Package imports
+from fastapi import HTTPException, status
+from jinja2 import (
+    BaseLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    select_autoescape,
+)
+
+try:
+    import resource
+except ImportError:  # not on Windows, only the CPU timer applies there
+    resource = None
+
+# Local imports
+from api.config import get_settings
+from api.utils import metrics
+from api.utils.cache import LRUCache
+from api.utils.workers import WorkerPool
+from api.meta.constants.errors import (
+    NOTE_RENDER_BUSY,
+    NOTE_RENDER_TIMEOUT,
+    NOTE_RENDER_TOO_LARGE,
+    NOTE_RENDER_UNAVAILABLE,
+)
+
+# -----------------------
+settings = get_settings()
+# -----------------------
+
+# Environments are thread safe once configured, one serves every request
+template_env = Environment(loader=BaseLoader())
+
+
+def build_page_env(bytecode_cache_path: str = None) -> Environment:
+    """
+    The environment of the trusted templates in JINJA_FILE_PATH, compiled
+    once per process, from their bytecode in bytecode_cache_path when an
+    earlier process left it there
+    """
+    if bytecode_cache_path is not None:
+        os.makedirs(bytecode_cache_path, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(settings.JINJA_FILE_PATH),
+        autoescape=select_autoescape(["html"]),
+        bytecode_cache=FileSystemBytecodeCache(bytecode_cache_path),
+        # templates only change with a deploy, don't stat them on every use
+        auto_reload=False,
+    )
+
+
+page_env = build_page_env(settings.JINJA_BYTECODE_CACHE_PATH)
+
+# Bump whenever the rendering of a description changes (environment options,
+# filters, globals...), stored renderings of older versions are redone
+RENDERER_VERSION = 1
+
+# CPU seconds a render process may run over its budget before the kernel
+# kills it, for renders stuck in C code that never see the CPU timer
+RENDER_KILL_GRACE = 1
+
+# Each render process has its own, note_renderer counts their hits and misses
+compiled_templates = LRUCache(settings.TEMPLATE_CACHE_SIZE)
+
+
+class RenderTimeout(Exception):
+    """The render used up its CPU time budget"""
+
+
+class RenderTooLarge(Exception):
+    """The render produced more than its output budget"""
+
+
+def load_template(source: str) -> tuple:
+    """
+    The compiled template of the source, compiling it on a cache miss, and
+    whether it came from the cache
+    """
+    key = sha256(source.encode()).digest()
+    template = compiled_templates.get(key)
+    if template is not None:
+        return template, True
+    template = template_env.from_string(source)
+    compiled_templates.set(key, template)
+    return template, False
+
+
+def get_template(source: str) -> Template:
+    """The compiled template of the source, compiling it on a cache miss"""
+    return load_template(source)[0]
+
+
+def render_counted(description: str, max_output: int = None) -> tuple:
+    """
+    Render in the calling thread, without more than max_output characters.
+    Returns the rendering and whether its template came from the cache.
+    """
+    # VULN: renders the template when using {{}}
+    template, cached = load_template(description)
+    chunks, size = [], 0
+    for chunk in template.generate():
+        size += len(chunk)
+        if max_output is not None and size > max_output:
+            raise RenderTooLarge()
+        chunks.append(chunk)
+    return "".join(chunks), cached
+
+
+def render_description(description: str, max_output: int = None) -> str:
+    """Render in the calling thread, without more than max_output characters"""
+    return render_counted(description, max_output)[0]
+
+
+def get_note_page() -> Template:
+    """The NOTE_TEMPLATE page, compiled by its first call"""
+    return page_env.get_template(settings.NOTE_TEMPLATE)
+
+
+def _out_of_cpu_time(signum, frame):
+    raise RenderTimeout()
+
+
+class RenderStarts:
+    """
+    The renders a pool of render processes has started, each process reports
+    the token of a render before running it. When a process dies and breaks
+    the pool, the renders that never started can safely run again.
+    """
+
+    def __init__(self):
+        self.queue = multiprocessing.get_context("spawn").SimpleQueue()
+        self._tokens = set()
+        self._lock = Lock()
+
+    def _collect(self) -> None:
+        while not self.queue.empty():
+            self._tokens.add(self.queue.get())
+
+    def started(self, token: int) -> bool:
+        with self._lock:
+            self._collect()
+            return token in self._tokens
+
+    def forget(self, token: int) -> None:
+        """Drop a finished render, collecting the reports keeps the pipe empty"""
+        with self._lock:
+            self._collect()
+            self._tokens.discard(token)
+
+
+# RenderStarts.queue of the pool, in a render process
+_render_starts = None
+
+
+def report_render_starts(queue) -> None:
+    """Initializer of the render processes"""
+    global _render_starts
+    _render_starts = queue
+
+
+def render_isolated(
+    description: str, cpu_seconds: float, max_output: int, token: int = None
+) -> tuple:
+    """
+    render_counted in a render process, with a profiling timer raising
+    RenderTimeout after cpu_seconds, and RLIMIT_CPU killing the process a
+    little later if the timer can't interrupt it
+    """
+    if token is not None and _render_starts is not None:
+        _render_starts.put(token)
+
+    limits = None
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        limits = resource.getrlimit(resource.RLIMIT_CPU)
+        used = usage.ru_utime + usage.ru_stime
+        kill_at = math.ceil(used + cpu_seconds) + RENDER_KILL_GRACE
+        if limits[1] != resource.RLIM_INFINITY:
+            kill_at = min(kill_at, limits[1])
+        resource.setrlimit(resource.RLIMIT_CPU, (kill_at, limits[1]))
+
+    signal.signal(signal.SIGPROF, _out_of_cpu_time)
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    try:
+        return render_counted(description, max_output)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, limits)
+
+
+class NoteRenderer(WorkerPool):
+    """
+    Renders descriptions in a WorkerPool. With processes=0 renders run in
+    threads, where only the output budget and the view timeout apply.
+
+    A render killed by RLIMIT_CPU breaks the whole process pool. The renders
+    that had started with it get a 503, the ones still queued run again on a
+    fresh pool within what is left of their timeout.
+    """
+
+    name = "rendering"
+    busy_detail = NOTE_RENDER_BUSY
+    unavailable_detail = NOTE_RENDER_UNAVAILABLE
+
+    def __init__(
+        self,
+        processes: int = None,
+        queue_size: int = 64,
+        cpu_seconds: float = 1.0,
+        timeout: float = 5.0,
+        max_output: int = 1_000_000,
+    ):
+        super().__init__(processes, queue_size)
+        if self.isolated:
+            # the timeout counts the wait in the queue, admit only the renders
+            # that finish in time even behind others using all their CPU
+            # budget, the next ones get a 429 instead of timing everyone out
+            in_time = self.processes * max(int(timeout / cpu_seconds), 1)
+            self.limit = min(self.limit, in_time)
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self.max_output = max_output
+        self.timeouts = 0
+        self.too_large = 0
+        self.retried = 0
+        self.template_hits = 0
+        self.template_misses = 0
+        self._tokens = count()
+
+    def _new_process_pool(self, **options) -> ProcessPoolExecutor:
+        starts = RenderStarts()
+        executor = super()._new_process_pool(
+            initializer=report_render_starts, initargs=(starts.queue,), **options
+        )
+        executor.starts = starts
+        return executor
+
+    def _render(self, description: str) -> Future:
+        if not self.isolated:
+            return self._submit(render_counted, description, self.max_output)
+        token = next(self._tokens)
+        future = self._submit(
+            render_isolated, description, self.cpu_seconds, self.max_output, token
+        )
+        future.token = token
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future: Future) -> None:
+        if future.cancelled() or not isinstance(future.exception(), BrokenProcessPool):
+            future.executor.starts.forget(future.token)
+
+    def _retry(self, future: Future, description: str) -> Future:
+        """
+        The render again on a fresh pool, after its pool broke, unless it had
+        started, it may be the one that killed its process
+        """
+        self._reset(future.executor)
+        if future.executor.starts.started(future.token):
+            raise self.unavailable()
+        with self._lock:
+            self.retried += 1
+        return self._render(description)
+
+    def _rendered(self, result: tuple) -> str:
+        """The rendering of a render_counted result, counting its template"""
+        rendered, cached = result
+        with self._lock:
+            if cached:
+                self.template_hits += 1
+            else:
+                self.template_misses += 1
+        return rendered
+
+    def _over_budget(self, future: Future, error: Exception) -> HTTPException:
+        """The error of a render out of its time or output budget"""
+        # still queued, nobody is waiting for it anymore
+        future.cancel()
+        with self._lock:
+            if isinstance(error, RenderTooLarge):
+                self.too_large += 1
+            else:
+                self.timeouts += 1
+        return HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=NOTE_RENDER_TOO_LARGE
+            if isinstance(error, RenderTooLarge)
+            else NOTE_RENDER_TIMEOUT,
+        )
+
+    def render(self, description: str) -> str:
+        """Render the description, blocking the calling thread until it's done"""
+        deadline = time.monotonic() + self.timeout
+        future = self._render(description)
+        try:
+            try:
+                result = future.result(self.timeout)
+            except BrokenProcessPool:
+                future = self._retry(future, description)
+                remaining = max(deadline - time.monotonic(), 0)
+                result = self._result(future, remaining)
+        except (RenderTimeout, RenderTooLarge, FutureTimeoutError) as error:
+            raise self._over_budget(future, error)
+        return self._rendered(result)
+
+    async def render_async(self, description: str) -> str:
+        """Render the description without blocking the event loop"""
+        deadline = time.monotonic() + self.timeout
+        future = self._render(description)
+        try:
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout
+                )
+            except BrokenProcessPool:
+                future = self._retry(future, description)
+                remaining = max(deadline - time.monotonic(), 0)
+                result = await self._result_async(future, remaining)
+        except (RenderTimeout, RenderTooLarge, AsyncTimeoutError) as error:
+            raise self._over_budget(future, error)
+        return self._rendered(result)
+
+    def stats(self) -> dict:
+        lookups = self.template_hits + self.template_misses
+        return {
+            **super().stats(),
+            "timeouts": self.timeouts,
+            "too_large": self.too_large,
+            "retried": self.retried,
+            # the template caches live in the render processes
+            "template_hits": self.template_hits,
+            "template_misses": self.template_misses,
+            "template_hit_ratio": self.template_hits / lookups if lookups else 0.0,
+        }
+
+
+note_renderer = NoteRenderer(
+    settings.RENDER_PROCESSES,
+    settings.RENDER_QUEUE_SIZE,
+    settings.RENDER_CPU_SECONDS,
+    settings.RENDER_TIMEOUT,
+    settings.RENDER_MAX_OUTPUT,
+)
+metrics.register("note_rendering", note_renderer.stats)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=note_renderer.forget)
+
+
+def rendered_columns(rendered: Optional[str]) -> dict:
+    """Note columns storing a rendering, None stores the lack of one"""
+    if rendered is None:
+        return {"rendered_description": None, "rendered_version": None}
+    return {"rendered_description": rendered, "rendered_version": RENDERER_VERSION}
+
+
+def prerender(description: str) -> dict:
+    """
+    Note columns storing the rendering of a new description, empty when
+    RENDER_ON_WRITE is off. A description that doesn't render, or not within
+    its budget, is stored without one and rendered again on its views.
+    """
+    if not settings.RENDER_ON_WRITE:
+        return {}
+    try:
+        return rendered_columns(note_renderer.render(description))
+    except Exception:
+        return rendered_columns(None)
+
+
+async def prerender_async(description: str) -> dict:
+    """Async version of prerender"""
+    if not settings.RENDER_ON_WRITE:
+        return {}
+    try:
+        return rendered_columns(await note_renderer.render_async(description))
+    except Exception:
+        return rendered_columns(None)
+
+
+def stored_rendering(note) -> Optional[str]:
+    """The rendering stored with the note, None if missing or outdated"""
+    if settings.RENDER_ON_WRITE and note.rendered_version == RENDERER_VERSION:
+        return note.rendered_description
+    return None
@@ -0,0 +1,172 @@
+"""
+workers.py
+The WorkerPool shared by the process pools of the api.
+It owns the executor, started on first use and again after a worker dies,
+counts the calls in flight to answer 429 past its limit and 503 when the
+pool is broken, and exposes the counters as metrics.
+"""
+# System imports
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+# Package imports
+from fastapi import HTTPException, status
+
+# Local imports
+from api.config import get_settings
+
+# -----------------------
+settings = get_settings()
+# -----------------------
+
+# Seconds a turned away client is asked to wait
+RETRY_AFTER = 1
+
+
+def default_processes() -> int:
+    """
+    The cores of the machine shared out between the WEB_CONCURRENCY workers,
+    at least one process each, so a pool has about one process per core
+    across all the workers instead of one per core in each of them
+    """
+    return max((os.cpu_count() or 1) // max(settings.WEB_CONCURRENCY, 1), 1)
+
+
+class WorkerPool:
+    """
+    Runs functions in a process pool with `processes` workers, by default
+    default_processes(), accepting at most `queue_size` calls on top of the
+    ones being worked on. With processes=0 the work runs in a thread pool of
+    the worker instead, still bounded by the queue.
+
+    Subclasses name the pool and the errors a client gets when it is busy
+    or broken.
+    """
+
+    name = "workers"
+    busy_detail = None
+    unavailable_detail = None
+
+    def __init__(self, processes: int = None, queue_size: int = 64):
+        self.processes = default_processes() if processes is None else processes
+        self.limit = max(self.processes, 1) + queue_size
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def isolated(self) -> bool:
+        """Whether the calls run in processes of their own"""
+        return self.processes > 0
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None and not self.isolated:
+                self._executor = ThreadPoolExecutor(thread_name_prefix=self.name)
+            elif self._executor is None:
+                self._executor = self._new_process_pool()
+            return self._executor
+
+    def _new_process_pool(self, **options) -> ProcessPoolExecutor:
+        # spawn, forking a process with running threads isn't safe
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            **options,
+        )
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self.pending >= self.limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail=self.busy_detail,
+                    headers={"Retry-After": str(RETRY_AFTER)},
+                )
+            self.pending += 1
+
+    def _release(self, future=None) -> None:
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def _submit(self, function, *args) -> Future:
+        """Queue the call, raising the backpressure errors right away"""
+        self._acquire()
+        executor = self._get_executor()
+        try:
+            future = executor.submit(function, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._release()
+            self._reset(executor)
+            raise self.unavailable()
+        # the pool of the call, only that one is reset if the call breaks it
+        future.executor = executor
+        future.add_done_callback(self._release)
+        return future
+
+    def _result(self, future: Future, timeout: float = None):
+        try:
+            return future.result(timeout)
+        except BrokenProcessPool:
+            # a worker died, the next call starts a fresh pool
+            self._reset(future.executor)
+            raise self.unavailable()
+
+    async def _result_async(self, future: Future, timeout: float = None):
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except BrokenProcessPool:
+            self._reset(future.executor)
+            raise self.unavailable()
+
+    def unavailable(self) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=self.unavailable_detail,
+            headers={"Retry-After": str(RETRY_AFTER)},
+        )
+
+    def _reset(self, broken: Executor = None) -> None:
+        """
+        Drop the executor, or only the broken one, which the calls that
+        failed with it report after a fresh one may have started
+        """
+        with self._lock:
+            executor = self._executor
+            if broken is not None and executor is not broken:
+                return
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self) -> None:
+        """Stop the worker processes, a later call starts new ones"""
+        self._reset()
+
+    def forget(self) -> None:
+        """Drop the pool inherited by a forked child, it belongs to the parent"""
+        self._executor = None
+        self._lock = Lock()
+        self.pending = 0
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.processes,
+            "pending": self.pending,
+            "limit": self.limit,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,116 @@
+"""
+insert_ids.py
+Insert throughput of the primary key strategies as the table grows
+
+    python -m benchmarks.insert_ids --rows 10000000
+
+Each strategy gets its own scratch table shaped like note (uuid primary key
+plus a short payload) in the configured database, which is dropped at the
+end. Throughput is reported for every --report rows, so the slowdown of
+random keys once the primary key index outgrows shared_buffers is visible.
+The server strategy inserts with RETURNING id, like the ORM has to.
+"""
+# System imports
+import argparse
+import time
+
+# Package imports
+from sqlalchemy import Column, MetaData, String, Table, create_engine, insert, text
+from sqlalchemy.dialects.postgresql import UUID
+
+# Local imports
+from api.config import IdStrategy
+from api.utils.database import get_database_url
+from api.meta.database.ids import ID_GENERATORS
+from api.meta.database.model import newUUIDSql
+
+
+def bench_table(metadata: MetaData, strategy: IdStrategy) -> Table:
+    return Table(
+        f"bench_ids_{strategy.value}",
+        metadata,
+        Column(
+            "id",
+            UUID(as_uuid=True),
+            primary_key=True,
+            server_default=text(newUUIDSql),
+        ),
+        Column("title", String(128), nullable=False),
+    )
+
+
+def run(engine, strategy: IdStrategy, rows: int, batch: int, report: int) -> list:
+    """Insert rows in batches, returns (rows so far, rows per second) per report"""
+    metadata = MetaData()
+    table = bench_table(metadata, strategy)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+    new_id = ID_GENERATORS[strategy]
+    statement = insert(table)
+    if new_id is None:
+        statement = statement.returning(table.c.id)
+
+    results = []
+    inserted = 0
+    started = time.perf_counter()
+    try:
+        while inserted < rows:
+            size = min(batch, rows - inserted)
+            if new_id is None:
+                values = [{"title": "benchmark note"} for _ in range(size)]
+            else:
+                values = [
+                    {"id": new_id(), "title": "benchmark note"} for _ in range(size)
+                ]
+
+            with engine.begin() as connection:
+                connection.execute(statement, values)
+            inserted += size
+
+            if inserted % report == 0 or inserted == rows:
+                elapsed = time.perf_counter() - started
+                results.append(
+                    (
+                        inserted,
+                        (inserted - (results[-1][0] if results else 0)) / elapsed,
+                    )
+                )
+                print(
+                    f"{strategy.value:>6} {inserted:>12,} rows {results[-1][1]:>12,.0f} rows/s"
+                )
+                started = time.perf_counter()
+    finally:
+        metadata.drop_all(engine)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--batch", type=int, default=10_000)
+    parser.add_argument("--report", type=int, default=1_000_000)
+    parser.add_argument(
+        "--strategy",
+        action="append",
+        type=IdStrategy,
+        help="strategies to compare, defaults to all of them",
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_engine(get_database_url())
+    summary = {}
+    for strategy in args.strategy or list(IdStrategy):
+        results = run(engine, strategy, args.rows, args.batch, args.report)
+        summary[strategy] = results[-1][1]
+
+    print("\nthroughput over the last report window")
+    for strategy, rate in summary.items():
+        print(f"{strategy.value:>6} {rate:>12,.0f} rows/s")
+
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
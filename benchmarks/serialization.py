@@ -0,0 +1,78 @@
+"""
+serialization.py
+Time to turn a page of note rows into a response body, through the
+pydantic models and FastAPI's response_model validation, and as the
+pre-shaped dicts the note endpoints send in an orjson JSONResponse
+
+    python -m benchmarks.serialization --sizes 10 1000 100000
+
+"models" is what fetch_notes used to do: one SimplifiedNoteObject per row,
+validated again against NotePage, run through jsonable_encoder and dumped by
+the json module. "shaped" builds plain dicts and lets orjson dump them. No
+database is needed.
+"""
+# System imports
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+
+# Package imports
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+# Local imports
+from api.endpoints.notes import build_notes_page
+from api.meta.constants.schemas import NotePage, SimplifiedNoteObject
+from api.utils import responses
+from api.utils.rows import NoteListRow
+
+page_field = create_response_field(name="Response_fetch_notes", type_=NotePage)
+
+
+async def models(rows: list) -> bytes:
+    page = NotePage(
+        notes=[SimplifiedNoteObject(id=row.id, title=row.title) for row in rows],
+        next_cursor=None,
+    )
+    content = await serialize_response(field=page_field, response_content=page)
+    return JSONResponse(content).body
+
+
+async def shaped(rows: list) -> bytes:
+    return responses.JSONResponse(build_notes_page(rows, len(rows))).body
+
+
+def run(serialize, rows: list, iterations: int) -> float:
+    """Milliseconds per serialisation of the rows"""
+
+    async def repeat():
+        await serialize(rows)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await serialize(rows)
+        return (time.perf_counter() - started) / iterations * 1000
+
+    return asyncio.run(repeat())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100_000])
+    args = parser.parse_args(argv)
+
+    now = datetime.now(timezone.utc)
+    print(f"{'notes':>8} {'models':>12} {'shaped':>12} {'speedup':>8}")
+    for size in args.sizes:
+        rows = [NoteListRow(uuid4(), f"note {i}", now) for i in range(size)]
+        # the same number of notes serialised for each size
+        iterations = max(1, 100_000 // size)
+        before = run(models, rows, iterations)
+        after = run(shaped, rows, iterations)
+        print(f"{size:>8} {before:>10.3f}ms {after:>10.3f}ms {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
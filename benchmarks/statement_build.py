@@ -0,0 +1,93 @@
+"""
+statement_build.py
+Per-request Python time spent building the hot queries, before and after
+moving them to lambda statements
+
+    python -m benchmarks.statement_build --iterations 20000
+
+Every request builds its statement and generates the cache key that looks it
+up in the engine's compiled cache, both are timed here. The compiled SQL is
+cached either way, so no database is needed. "before" builds the statement
+trees the endpoints used to build, "after" the ones of api.utils.statements.
+"""
+# System imports
+import argparse
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+
+# Package imports
+from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload, raiseload
+
+# Local imports
+from api.meta.database.model import Note, User
+from api.utils import statements
+from api.utils.pagination import keyset_after
+from api.utils.rows import NoteListRow, select_rows
+
+
+def notes_page(user_id, after, limit):
+    note = Note.__table__
+    query = select_rows(NoteListRow, note).where(note.c.user_id == user_id)
+    if after is not None:
+        query = query.where(keyset_after(note.c.created_date, note.c.id, *after))
+    return query.order_by(note.c.created_date.desc(), note.c.id.desc()).limit(limit + 1)
+
+
+BEFORE = {
+    "principal_by_id": lambda user_id: select(
+        User.id, User.username, User.is_admin
+    ).filter(User.id == user_id),
+    "user_by_username": lambda username: select(User)
+    .options(raiseload(User.notes))
+    .filter(func.lower(User.username) == username.lower()),
+    "note_with_owner": lambda note_id: select(Note)
+    .options(joinedload(Note.user))
+    .filter(Note.id == note_id),
+    "notes_page": notes_page,
+}
+
+AFTER = {
+    "principal_by_id": statements.principal_by_id,
+    "user_by_username": statements.user_by_username,
+    "note_with_owner": statements.note_with_owner,
+    "notes_page": statements.notes_page,
+}
+
+
+def arguments(name: str) -> tuple:
+    """Fresh bound values for every call, like every request has"""
+    if name == "user_by_username":
+        return (f"user-{uuid4().hex[:8]}",)
+    if name == "notes_page":
+        return (uuid4(), (datetime.now(timezone.utc), uuid4()), 50)
+    return (str(uuid4()),)
+
+
+def run(build, name: str, iterations: int) -> float:
+    """Microseconds per statement build plus cache key generation"""
+    calls = [arguments(name) for _ in range(iterations)]
+    # the first call of a lambda statement analyses it, like the first request
+    build(*calls[0])._generate_cache_key()
+
+    started = time.perf_counter()
+    for args in calls:
+        build(*args)._generate_cache_key()
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--iterations", type=int, default=20_000)
+    args = parser.parse_args(argv)
+
+    print(f"{'statement':<18} {'before':>10} {'after':>10} {'speedup':>8}")
+    for name in BEFORE:
+        before = run(BEFORE[name], name, args.iterations)
+        after = run(AFTER[name], name, args.iterations)
+        print(f"{name:<18} {before:>8.1f}us {after:>8.1f}us {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+token_decode.py
+Cost of authenticating a bearer token, with and without the verified
+token cache of AuthHandler
+
+    python -m benchmarks.token_decode --iterations 100000
+
+A client sends the same token on every request of its session, so every
+decode after the first one is a cache hit. No database is needed.
+"""
+# System imports
+import argparse
+import time
+from uuid import uuid4
+
+# Local imports
+from api.utils.auth import AuthHandler
+from api.utils.cache import LRUCache
+
+
+def run(handler: AuthHandler, token: str, iterations: int) -> float:
+    """Microseconds per decode_token call"""
+    handler.decode_token(token)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        handler.decode_token(token)
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--iterations", type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    token = AuthHandler().encode_token(str(uuid4()))
+
+    uncached = AuthHandler()
+    uncached.verified_tokens = LRUCache(0)
+    cached = AuthHandler()
+    cached.verified_tokens = LRUCache(1000)
+
+    without_cache = run(uncached, token, args.iterations)
+    with_cache = run(cached, token, args.iterations)
+    print(f"without cache {without_cache:>8.2f}us per decode")
+    print(f"with cache    {with_cache:>8.2f}us per decode")
+    print(f"speedup       {without_cache / with_cache:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()